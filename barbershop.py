@@ -2,17 +2,87 @@
 # -*- coding: utf-8 -*-
 import sys
 import re
-import matplotlib.pyplot as plt
+import io
+import threading
 from cactusUtils import *
+import fastx
+import compression
+import trimmer
+import kmerfilter
+import derep
+import diginorm
+import rejects
+import qualstats
+import qualplots
 from collections import Counter
 from shutil import copyfile
-from subprocess import call
+from subprocess import call, Popen, PIPE
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import fcntl
 import logging
 
 
 """ barbershop.py: Simple trimming on raw fastq reads """
 
+#smallest thread share a read group gets when the number of concurrent read groups is automatic
+MIN_THREADS_PER_READGROUP = 8
+
+#reads sent to one blastn run when screening a record stream against univec
+UNIVEC_WINDOW = 100000
+
+#set by performQC for the forked read group workers
+_activeBarberShop = None
+
+def _processReadgroup(readgroupName, readgroupFile, threads):
+    _activeBarberShop.processReadgroup(readgroupName, readgroupFile, threads)
+
+""" Reads blastn csv output lines into a dict of qseqid -> (qstart, qend), the last line of a query wins.
+    blastn does not promise to report queries in input order (-num_threads), so hits are looked up by name """
+def univecHitTable(lines):
+    hits = {}
+    for line in lines:
+        lineSplit = line.split(',', 4)
+        hits[lineSplit[0]] = (int(lineSplit[2]), int(lineSplit[3]))
+    return hits
+
+""" Trims a univec hit off a read when it sits near either end, returns (seq, qual, trimmed) """
+def univecTrim(seq, qual, begin, end):
+    fromBeginning = begin
+    fromEnd = len(seq) - end
+
+    if fromBeginning <= 25 or fromEnd <= 25:
+        return seq[:begin], qual[:begin], True
+    return seq, qual, False
+
+""" Runs write(handle) on a background thread so the stdout of a tool can be read while its stdin is fed,
+    exceptions end up in the returned list """
+def feedProcess(handle, write):
+    failures = []
+
+    def feed():
+        try:
+            write(handle)
+        except Exception as e:
+            failures.append(e)
+        finally:
+            try:
+                handle.close()
+            except BrokenPipeError:
+                pass
+
+    thread = threading.Thread(target=feed, daemon=True)
+    thread.start()
+    return thread, failures
+
+""" Passes records through while writing them to path """
+def teeFastq(records, path, codec):
+    with compression.openOutput(path, codec) as handle:
+        for record in records:
+            handle.write('@' + record[0] + '\n' + record[1] + '\n+\n' + record[2] + '\n')
+            yield record
+
 class barberShopObject:
 
     def __init__(self, readGroups, outputPath, args):
@@ -34,79 +104,327 @@ class barberShopObject:
         self.logger = logging.getLogger('cactus')
         self.logger.info('Barbershop object created ')
 
+        #vsearch and cutadapt read gzip natively, other codecs would break the external steps
+        self.intermediateCodec = self.args.get('barbershop', 'intermediateCompression', fallback=compression.CODEC_NONE)
+        if self.intermediateCodec not in (compression.CODEC_NONE, compression.CODEC_GZIP):
+            raise Exception('barbershop intermediateCompression must be none or gzip, got: ' + str(self.intermediateCodec))
+        self.intermediateSuffix = compression.suffixFor(self.intermediateCodec)
+
+        self.rejectMode = rejects.sinkMode(self.args)
+        self.pipelined = self.args.getboolean('barbershop', 'pipelined', fallback=False)
+        self.keepIntermediates = self.args.getboolean('barbershop', 'keepIntermediates', fallback=False)
+        self.stagingMode = self.args.get('barbershop', 'stagingMode', fallback=STAGING_COPY)
+        if self.stagingMode not in (STAGING_COPY, STAGING_AUTO):
+            raise Exception('barbershop stagingMode must be copy or auto, got: ' + str(self.stagingMode))
+
+        self.univecKmers = None
         if self.args.getboolean('barbershop', 'enableUnivec') is True:
             self.checkAndCreateCustomUnivec()
 
-    """ Run QC """
+            #built before read groups are forked off so all workers share it
+            if self.args.getboolean('barbershop', 'univecPrefilter', fallback=False) is True:
+                k = self.args.getint('barbershop', 'univecPrefilterK', fallback=kmerfilter.DEFAULT_K)
+                self.univecKmers = kmerfilter.indexFromFasta(self.barberUnivecFasta, k)
+                self.logger.info('Univec k-mer prefilter built, k: ' + str(k) + ', distinct k-mers: ' + str(len(self.univecKmers)))
+
+    """ Run QC, independent read groups are processed concurrently within the CPU budget """
     def performQC(self):
 
         self.logger.info('Starting QC')
 
-        for readgroup in self.readGroups:
-            readgroupName = readgroup[0]
-            readgroupFile = readgroup[1]
-
-            self.logger.info('Processing ' + str(readgroupName))
+        jobs, threads = self.readgroupSchedule()
+        self.logger.info('Read groups in flight: ' + str(jobs) + ', threads per read group: ' + str(threads))
+
+        if jobs <= 1:
+            for readgroup in self.readGroups:
+                self.processReadgroup(readgroup[0], readgroup[1], threads)
+            self.renderQualityReports()
+            return
+
+        #forked workers inherit this object, only the read group itself is sent over
+        global _activeBarberShop
+        _activeBarberShop = self
+        try:
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork')) as executor:
+                futures = [executor.submit(_processReadgroup, readgroup[0], readgroup[1], threads) for readgroup in self.readGroups]
+                for future in futures:
+                    future.result()
+        finally:
+            _activeBarberShop = None
+
+        self.renderQualityReports()
+        return
 
-            #check if this file exists
-            if os.path.isfile(readgroupFile) is False:
-                self.logger.error('Could not find sequence file as defined in readgroups:' + readgroupFile)
-                raise Exception('Could not find sequence file as defined in readgroups:' + readgroupFile)
+    """ Renders the graphs from the quality summaries the trimmer wrote, after all read groups are done """
+    def renderQualityReports(self):
+        for readgroup in self.readGroups:
+            summaryPath = self.barberOutput + '/' + readgroup[0] + '.quals.npz'
+            if os.path.isfile(summaryPath) is False:
+                continue
+
+            if qualplots.renderSummary(summaryPath, self.barberGraphs + '/' + readgroup[0] + '.quality.png', readgroup[0]) is False:
+                self.logger.warning('matplotlib not available, quality graphs not rendered')
+                return
+
+    """ Number of read groups to run at once and the number of threads each of them gets """
+    def readgroupSchedule(self):
+        budget = self.args.getint('barbershop', 'cpuBudget', fallback=0)
+        if budget <= 0:
+            budget = availableCores()
+
+        jobs = self.args.getint('barbershop', 'concurrentReadgroups', fallback=1)
+        if jobs <= 0:
+            jobs = max(1, budget // MIN_THREADS_PER_READGROUP)
+
+        jobs = max(1, min(jobs, len(self.readGroups), budget))
+        threads = max(1, budget // jobs)
+        return jobs, threads
+
+    """ Runs all enabled QC steps for one read group, external tools get the given number of threads """
+    def processReadgroup(self, readgroupName, readgroupFile, threads):
+
+        self.logger.info('Processing ' + str(readgroupName))
+
+        #check if this file exists
+        if os.path.isfile(readgroupFile) is False:
+            self.logger.error('Could not find sequence file as defined in readgroups:' + readgroupFile)
+            raise Exception('Could not find sequence file as defined in readgroups:' + readgroupFile)
+
+        #stage without copying data where possible, the raw input is never moved
+        inputSuffix = compression.suffixFor(compression.detectCompression(readgroupFile))
+        outputPath = self.barberOutput + '/' + readgroupName + '.original.fastq' + inputSuffix
+        method = stageFile(readgroupFile, outputPath, self.stagingMode)
+        self.logger.debug('Staged ' + str(readgroupName) + ' using ' + method)
+
+        workFile = outputPath
+
+        if self.args.getboolean('barbershop', 'enabled') is True and self.pipelined is True:
+            self.pipelineReadgroup(readgroupName, workFile, threads)
+            return
+
+        if self.args.getboolean('barbershop', 'enabled') is True:
+            #every step appends its rejects, start from an empty sink
+            rejects.rejectSink(self.rejectPath(readgroupName), self.rejectMode, append=False).close()
+
+            if self.args.getboolean('barbershop', 'enableTrimmer') is True:
+                self.logger.debug('Trimmer')
+                self.qcChecker(readgroupName,workFile,threads)
+                workFile =  self.barberOutput + '/' + readgroupName + '.trimmed.fastq' + self.intermediateSuffix
+
+            if self.args.getboolean('barbershop', 'enableCutAdapt') is True:
+                self.logger.debug('CutAdapt screening')
+                self.primerTrimming(readgroupName,workFile,threads)
+                workFile = self.barberOutput + '/' + readgroupName + '.cutadapt.fastq' + self.intermediateSuffix
+
+            if self.args.getboolean('barbershop', 'enableUnivec') is True:
+                self.logger.debug('Univec screening')
+                self.uniVecScreening(readgroupName,workFile,threads)
+                workFile = self.barberOutput + '/' + readgroupName + '.univec.fastq' + self.intermediateSuffix
+
+            if self.args.getboolean('barbershop', 'enableCompression') is True:
+                self.logger.debug('Compressing')
+                self.compressReadgroup(readgroupName,workFile,threads)
+                workFile = self.barberOutput + '/' + readgroupName + '.compressed.fastq' + self.intermediateSuffix
+
+            if self.args.getboolean('barbershop', 'enableNormalization', fallback=False) is True:
+                self.logger.debug('Normalizing')
+                self.normalizeReadgroup(readgroupName,workFile,threads)
+                workFile = self.barberOutput + '/' + readgroupName + '.normalized.fastq' + self.intermediateSuffix
+        else:
+            self.logger.warn('barbershop not enabled, skipping for:' + str(readgroupName))
 
-            #copy to staging area
-            outputPath = self.barberOutput + '/' + readgroupName + '.original.fastq'
-            copyfile(readgroupFile, outputPath)
+        outputSuffix = compression.suffixFor(compression.detectCompression(workFile))
+        outputPath = self.barberOutput + '/' + readgroupName + '.fastq' + outputSuffix
+        method = stageFile(workFile, outputPath, self.stagingMode, owned=True)
+        self.logger.debug('Final output for ' + str(readgroupName) + ' placed using ' + method)
 
-            workFile = outputPath
+        return
 
-            if self.args.getboolean('barbershop', 'enabled') is True:
+    """ Runs the enabled QC steps as one stream of records: python steps are chained generators, cutadapt and
+        blastn are fed and read through pipes. Intermediate fastq files are only written with keepIntermediates,
+        clustering below compressionId 1.00 needs the whole read set and spills its input to disk """
+    def pipelineReadgroup(self, readgroupName, inputPath, threads):
+        rejectSink = rejects.rejectSink(self.rejectPath(readgroupName), self.rejectMode, append=False)
+        histograms = qualstats.qualityHistograms()
+        trimCounters = trimmer.newCounters()
+        abundances = None
+        normalizationCounts = Counter({'kept': 0, 'dropped': 0})
+        records = fastx.fastqIter(inputPath, shortName=True)
+
+        if self.args.getboolean('barbershop', 'enableTrimmer') is True:
+            processes = min(trimmer.trimmerProcesses(self.args), threads)
+            records = trimmer.trimStream(records, trimmer.trimmerSettings(self.args), rejectSink, histograms, trimCounters, processes)
+            records = self.intermediate(readgroupName, '.trimmed.fastq', records)
+
+        #the steps before cutadapt run on its feeder thread, they share the (locked) reject sink with the later steps
+        if self.args.getboolean('barbershop', 'enableCutAdapt') is True:
+            records = self.primerTrimmingStream(readgroupName, records, threads)
+            records = self.intermediate(readgroupName, '.cutadapt.fastq', records)
 
-                if self.args.getboolean('barbershop', 'enableTrimmer') is True:
-                    self.logger.debug('Trimmer')
-                    self.qcChecker(readgroupName,workFile)
-                    workFile =  self.barberOutput + '/' + readgroupName + '.trimmed.fastq'
+        if self.args.getboolean('barbershop', 'enableUnivec') is True:
+            records = self.uniVecStream(readgroupName, records, threads, rejectSink)
+            records = self.intermediate(readgroupName, '.univec.fastq', records)
+
+        if self.args.getboolean('barbershop', 'enableCompression') is True:
+            if self.args.getfloat('barbershop', 'compressionId') >= 1.0:
+                bothStrands = self.args.get('barbershop', 'compressionStrand', fallback=derep.STRAND_PLUS) == derep.STRAND_BOTH
+                abundances = []
+                records = derep.dereplicateStream(records, bothStrands, rejectSink, abundances)
+                records = self.intermediate(readgroupName, '.compressed.fastq', records)
+            else:
+                spillPath = self.barberOutput + '/' + readgroupName + '.precompression.fastq' + self.intermediateSuffix
+                with compression.openOutput(spillPath, self.intermediateCodec) as spillHandle:
+                    fastx.writeFastq(spillHandle, records)
+                self.compressReadgroup(readgroupName, spillPath, threads, rejectSink)
+                records = fastx.fastqIter(self.barberOutput + '/' + readgroupName + '.compressed.fastq' + self.intermediateSuffix, shortName=True)
+
+        if self.args.getboolean('barbershop', 'enableNormalization', fallback=False) is True:
+            records = diginorm.normalizeStream(records, rejectSink, normalizationCounts,
+                k=self.args.getint('barbershop', 'normalizationK', fallback=diginorm.DEFAULT_K),
+                depth=self.args.getint('barbershop', 'normalizationDepth', fallback=diginorm.DEFAULT_DEPTH),
+                tables=self.args.getint('barbershop', 'normalizationTables', fallback=diginorm.DEFAULT_TABLES),
+                tableBits=self.args.getint('barbershop', 'normalizationTableBits', fallback=diginorm.DEFAULT_TABLE_BITS))
+            records = self.intermediate(readgroupName, '.normalized.fastq', records)
+
+        #pulling the last step runs the whole pipeline
+        outputPath = self.barberOutput + '/' + readgroupName + '.fastq' + self.intermediateSuffix
+        with rejectSink, compression.openOutput(outputPath, self.intermediateCodec) as outputHandle:
+            fastx.writeFastq(outputHandle, records)
+
+        if self.args.getboolean('barbershop', 'enableTrimmer') is True:
+            histograms.save(self.barberOutput + '/' + readgroupName + '.quals.npz')
+            self.logger.debug('Trimmer quality control dropped reads: ' + str(trimCounters['readsDropped']))
+            self.logger.debug('Trimmer quality control dropped because of compression ratio: ' + str(trimCounters['readsCompressionRatioDropped']))
+            self.logger.debug('Trimmer quality control length-salvaged reads: ' + str(trimCounters['readsSalvaged']))
+            self.logger.debug('Trimmer sum of reads written: ' + str(trimCounters['readsWritten']))
+
+        if abundances is not None:
+            derep.writeAbundances(abundances, self.barberOutput + '/' + readgroupName + '.compression.result')
+            self.logger.debug('Compressor number of unique sequences: ' + str(len(abundances)))
+
+        if self.args.getboolean('barbershop', 'enableNormalization', fallback=False) is True:
+            self.logger.debug('Normalization kept reads: ' + str(normalizationCounts['kept']))
+            self.logger.debug('Normalization dropped reads: ' + str(normalizationCounts['dropped']))
+
+        self.logger.debug('Final output for ' + str(readgroupName) + ' written by the pipeline')
+        return
 
-                if self.args.getboolean('barbershop', 'enableCutAdapt') is True:
-                    self.logger.debug('CutAdapt screening')
-                    self.primerTrimming(readgroupName,workFile)
-                    workFile = self.barberOutput + '/' + readgroupName + '.cutadapt.fastq'
+    """ Passes records through, writing them to the intermediate file of a step when keepIntermediates is set """
+    def intermediate(self, readgroupName, suffix, records):
+        if self.keepIntermediates is False:
+            return records
+        return teeFastq(records, self.barberOutput + '/' + readgroupName + suffix + self.intermediateSuffix, self.intermediateCodec)
 
-                if self.args.getboolean('barbershop', 'enableUnivec') is True:
-                    self.logger.debug('Univec screening')
-                    self.uniVecScreening(readgroupName,workFile)
-                    workFile = self.barberOutput + '/' + readgroupName + '.univec.fastq'
+    """ primerTrimming on a record stream, cutadapt reads the records from stdin and writes the trimmed reads to stdout """
+    def primerTrimmingStream(self, readgroupName, records, threads):
+        log = self.barberOutput + '/' + readgroupName + '.cutadapt.report.txt'
 
-                if self.args.getboolean('barbershop', 'enableCompression') is True:
-                    self.logger.debug('Compressing')
-                    self.compressReadgroup(readgroupName,workFile)
-                    workFile = self.barberOutput + '/' + readgroupName + '.compressed.fastq'
+        #with the reads on stdout cutadapt writes its report to stderr
+        with open(log, 'w') as logHandle, Popen([self.args.get('bin', 'cutadapt'),
+                '-b', 'file:' + self.args.get('barbershop', 'cutAdaptPrimers'),
+                '-e', '0.1',
+                '-j', str(threads),
+                '-',
+            ], stdin=PIPE, stdout=PIPE, stderr=logHandle) as process:
+
+            feeder, failures = feedProcess(io.TextIOWrapper(process.stdin, encoding='latin-1'), lambda handle: fastx.writeFastq(handle, records))
+            yield from fastx.fastqIter(process.stdout, shortName=True)
+            feeder.join()
+
+        if failures:
+            raise failures[0]
+        if process.returncode != 0:
+            raise Exception('cutadapt exited with code ' + str(process.returncode) + ' for ' + readgroupName)
+
+    """ uniVecScreening on a record stream, reads are screened in windows of UNIVEC_WINDOW with one blastn run
+        per window fed through a pipe, so memory is bounded by the window and not the read group """
+    def uniVecStream(self, readgroupName, records, threads, rejectSink):
+        counts = Counter({'trims': 0, 'rejects': 0})
+        window = []
+        firstOrdinal = 0
+
+        for record in records:
+            window.append(record)
+            if len(window) == UNIVEC_WINDOW:
+                yield from self.screenUnivecWindow(window, firstOrdinal, threads, rejectSink, counts)
+                firstOrdinal += len(window)
+                window = []
+
+        if window:
+            yield from self.screenUnivecWindow(window, firstOrdinal, threads, rejectSink, counts)
+
+        self.logger.debug('Univec based trims: ' + str(counts['trims']))
+        self.logger.debug('Univec based rejects: ' + str(counts['rejects']))
+
+    def screenUnivecWindow(self, window, firstOrdinal, threads, rejectSink, counts):
+        if self.univecKmers is None:
+            candidates = window
+        else:
+            candidates = []
+            for start in range(0, len(window), kmerfilter.BATCH_SIZE):
+                batch = window[start:start + kmerfilter.BATCH_SIZE]
+                candidates.extend(record for hit, record in zip(self.univecKmers.hasHits([seq for name, seq, qual in batch]).tolist(), batch) if hit)
+
+        hits = {}
+        if candidates:
+            def writeCandidates(handle):
+                for name, seq, qual in candidates:
+                    handle.write('>' + name + '\n' + seq + '\n')
+
+            with Popen(self.univecBlastCommand('-', threads), stdin=PIPE, stdout=PIPE, encoding='latin-1', bufsize=1024*1024) as blastProcess:
+                feeder, failures = feedProcess(blastProcess.stdin, writeCandidates)
+                hits = univecHitTable(blastProcess.stdout)
+                feeder.join()
+
+            if failures:
+                raise failures[0]
+            if blastProcess.returncode != 0:
+                self.logger.error('blastn exited with code ' + str(blastProcess.returncode) + ' while screening a window of reads')
+
+        minLength = self.args.getint('barbershop', 'minLengthForUnivecTrim')
+        for i, (name, seq, qual) in enumerate(window):
+            hit = hits.get(name)
+            if hit is not None:
+                seq, qual, trimmed = univecTrim(seq, qual, hit[0], hit[1])
+                counts['trims'] += trimmed
+
+            if len(seq) <= minLength:
+                rejectSink.reject(firstOrdinal + i, rejects.UNIVEC_FRAG_TOO_SMALL, name, seq, qual)
+                counts['rejects'] += 1
             else:
-                self.logger.warn('barbershop not enabled, skipping for:' + str(readgroupName))
+                yield name, seq, qual
 
-            outputPath = self.barberOutput + '/' + readgroupName + '.fastq'
-            copyfile(workFile, outputPath)
+    """ Collapses reads, exact duplicates are removed in-process at compressionId 1.00, lower identities cluster with vsearch.
+        Removed reads go to rejectSink, by default the sink of the read group is opened for appending """
+    def compressReadgroup(self, readgroupName, readgroupInput, threads, rejectSink = None):
+        if rejectSink is None:
+            with rejects.rejectSink(self.rejectPath(readgroupName), self.rejectMode) as rejectSink:
+                return self.compressReadgroup(readgroupName, readgroupInput, threads, rejectSink)
 
-        return
+        fastqOut = self.barberOutput + '/' + readgroupName + '.compressed.fastq' + self.intermediateSuffix
+        vsearchOut = self.barberOutput + '/' + readgroupName + '.compression.result'
 
-    def compressReadgroup(self, readgroupName, readgroupInput):
+        if self.args.getfloat('barbershop', 'compressionId') >= 1.0:
+            bothStrands = self.args.get('barbershop', 'compressionStrand', fallback=derep.STRAND_PLUS) == derep.STRAND_BOTH
+            kept = derep.dereplicate(readgroupInput, fastqOut, self.intermediateCodec, bothStrands, rejectSink)
+            derep.writeAbundances(kept, vsearchOut)
+            self.logger.debug('Compressor number of unique sequences: ' + str(len(kept)))
+            return
 
         nullHandle = open('/dev/null', 'w')
 
-        fastqOut = self.barberOutput + '/' + readgroupName + '.compressed.fastq'
-        vsearchOut = self.barberOutput + '/' + readgroupName + '.compression.result'
-
         call([self.args.get('bin', 'vsearch'),
             '--quiet',
             '--cluster_fast', readgroupInput,
             '--consout', vsearchOut,
             '--sizeout',
-            '--threads', '32',
+            '--threads', str(threads),
             '--id', self.args.get('barbershop', 'compressionId'),
         ], stdout=nullHandle)
 
 
         centroids = defaultdict(dict)
-        for name, seq in fastaIter(vsearchOut):
+        for name, seq in fastx.fastaIter(vsearchOut):
             realName = re.findall ( '\=(.*?)\;', name)
             try:
                 centroids[realName[0]] = name
@@ -115,61 +433,105 @@ class barberShopObject:
                 print(realName)
                 sys.exit()
 
-        outputHandle = open(fastqOut, 'w')
-        readgroupHandle = open(readgroupInput, 'r')
+        outputHandle = compression.openOutput(fastqOut, self.intermediateCodec)
 
         self.logger.debug('Compressor number of centroids: ' + str(len(centroids)))
 
-        for name, seq, qual in readfq(readgroupHandle):
+        for ordinal, (name, seq, qual) in enumerate(fastx.fastqIter(readgroupInput, shortName=True)):
             if name in centroids:
                 outputHandle.write('@' + name + '\n')
                 outputHandle.write(seq + '\n')
                 outputHandle.write('+' + '\n')
                 outputHandle.write(qual + '\n')
+            else:
+                #clustered into a centroid, like an exact duplicate it is only dropped (the index needs its ordinal)
+                rejectSink.drop(ordinal, rejects.DEREP_DUPLICATE)
 
         nullHandle.close()
         outputHandle.close()
         return
 
+    """ Digital normalization, drops reads whose k-mers already reached normalizationDepth """
+    def normalizeReadgroup(self, readgroupName, readgroupInput, threads):
+        outputPath = self.barberOutput + '/' + readgroupName + '.normalized.fastq' + self.intermediateSuffix
+
+        with rejects.rejectSink(self.rejectPath(readgroupName), self.rejectMode) as rejectSink:
+            kept, dropped = diginorm.normalize(readgroupInput, outputPath, rejectSink, self.intermediateCodec,
+                k=self.args.getint('barbershop', 'normalizationK', fallback=diginorm.DEFAULT_K),
+                depth=self.args.getint('barbershop', 'normalizationDepth', fallback=diginorm.DEFAULT_DEPTH),
+                tables=self.args.getint('barbershop', 'normalizationTables', fallback=diginorm.DEFAULT_TABLES),
+                tableBits=self.args.getint('barbershop', 'normalizationTableBits', fallback=diginorm.DEFAULT_TABLE_BITS))
+
+        self.logger.debug('Normalization kept reads: ' + str(kept))
+        self.logger.debug('Normalization dropped reads: ' + str(dropped))
+        return
+
+    """ Creates the univec blast database, when univecCacheDir is set the database is built once per
+        unique univec/addition content and reused by later (and concurrent) runs """
     def checkAndCreateCustomUnivec(self):
 
         addition = self.args.get('barbershop', 'customUnivecAddition')
         original = self.args.get('barbershop', 'univecdb')
+        cacheDir = self.args.get('barbershop', 'univecCacheDir', fallback='')
+
+        if not cacheDir:
+            self.createCustomUnivec(original, addition, self.barberUnivecFasta, self.barberUnivecDb)
+            return
+
+        sources = [original] if addition == 'False' else [original, addition]
+        key = fileDigest(sources, [self.args.get('bin', 'makeblastdb')])
+        entry = os.path.join(cacheDir, key)
+        #several runs can share the cache, the lock below handles the rest
+        os.makedirs(cacheDir, exist_ok=True)
+
+        #an entry directory only ever appears through the rename below, so it is always complete
+        with open(entry + '.lock', 'w') as lockHandle:
+            fcntl.flock(lockHandle, fcntl.LOCK_EX)
+
+            if os.path.isdir(entry) is False:
+                self.logger.info('Univec cache miss, building database: ' + key)
+                tmpEntry = entry + '.' + str(os.getpid()) + '.tmp'
+                if os.path.isdir(tmpEntry):
+                    removeDirectoryTree(tmpEntry)
+                os.makedirs(tmpEntry)
+
+                returnCode = self.createCustomUnivec(original, addition, tmpEntry + '/univec.fasta', tmpEntry + '/cactusunivec')
+                if returnCode != 0:
+                    removeDirectoryTree(tmpEntry)
+                    raise Exception('makeblastdb failed while building the univec cache entry: ' + key)
+
+                os.rename(tmpEntry, entry)
+            else:
+                self.logger.info('Univec cache hit, reusing database: ' + key)
 
-        if addition == 'False':
-            self.logger.info('Creating univec database as-is')
-            originalHandle = open(original, 'r')
-            destinationHandle = open(self.barberUnivecFasta,'w')
-            shutil.copyfileobj(originalHandle , destinationHandle, 1024*1024*10)
-        else:
-            univecDb = self.args.get('barbershop', 'univecDb')
-            self.logger.info('Creating extended univec database')
-
-            originalHandle = open(original, 'r')
-            destinationHandle = open(self.barberUnivecFasta,'w')
-            shutil.copyfileobj(originalHandle , destinationHandle, 1024*1024*10)
-            destinationHandle.close()
+        self.barberUnivecFasta = entry + '/univec.fasta'
+        self.barberUnivecDb = entry + '/cactusunivec'
 
-            with open(self.barberUnivecFasta,'a') as customUnivec, open(addition, 'r') as univecAdditions:
-                customUnivec.write(univecAdditions.read())
+    """ Writes univec (plus additions) to fastaPath and runs makeblastdb on it, returns the makeblastdb exit code """
+    def createCustomUnivec(self, original, addition, fastaPath, dbPath):
 
-            customUnivec.close()
-            univecAdditions.close()
+        with open(fastaPath, 'w') as destinationHandle:
+            with open(original, 'r') as originalHandle:
+                shutil.copyfileobj(originalHandle , destinationHandle, 1024*1024*10)
 
-        #else:
+            if addition == 'False':
+                self.logger.info('Creating univec database as-is')
+            else:
+                self.logger.info('Creating extended univec database')
+                with open(addition, 'r') as univecAdditions:
+                    destinationHandle.write(univecAdditions.read())
 
-        call([self.args.get('bin', 'makeblastdb'),
-            '-in', self.barberUnivecFasta,
+        return call([self.args.get('bin', 'makeblastdb'),
+            '-in', fastaPath,
             '-dbtype', 'nucl',
             '-input_type', 'fasta',
             '-title', 'cactusunivec',
-            '-out', self.barberUnivecDb,
+            '-out', dbPath,
         ])
 
+    def primerTrimming(self, readgroupName, readgroupInput, threads):
 
-    def primerTrimming(self, readgroupName, readgroupInput):
-
-        thisOut = self.barberOutput + '/' + readgroupName + '.cutadapt.fastq'
+        thisOut = self.barberOutput + '/' + readgroupName + '.cutadapt.fastq' + self.intermediateSuffix
         log = self.barberOutput + '/' + readgroupName + '.cutadapt.report.txt'
         logAhandle = open(log, 'w')
 
@@ -177,26 +539,49 @@ class barberShopObject:
                 '-b', 'file:' + self.args.get('barbershop', 'cutAdaptPrimers'),
                 '-o', thisOut,
                 '-e', '0.1',
+                '-j', str(threads),
                 readgroupInput,
             ], stdout=logAhandle)
 
         return
 
 
-    def uniVecScreening(self, readgroupName, readgroupInput ):
+    def uniVecScreening(self, readgroupName, readgroupInput, threads):
 
         nullHandle = open('/dev/null', 'w')
         fastaOut = self.barberOutput + '/' + readgroupName + '.fasta'
-        univecOut = self.barberOutput + '/' + readgroupName + '.txt'
 
-        call([self.args.get('bin', 'vsearch'),
-            '--quiet',
-            '--fastx_filter', readgroupInput,
-            '--fastq_qmax', '80',
-            '--fastaout', fastaOut,
-        ], stdout=nullHandle)
+        if self.univecKmers is None:
+            call([self.args.get('bin', 'vsearch'),
+                '--quiet',
+                '--fastx_filter', readgroupInput,
+                '--fastq_qmax', '80',
+                '--fastaout', fastaOut,
+            ], stdout=nullHandle)
+            candidates = None
+        else:
+            candidates = self.writeUnivecCandidates(readgroupInput, fastaOut)
+
+        nullHandle.close()
+
+        if candidates == 0:
+            #nothing can hit univec, skip blastn altogether
+            self.trimUnivecHits(readgroupName, readgroupInput, {})
+            return
+
+        #hits are streamed straight from blastn into a lookup table, no hits file is written
+        with Popen(self.univecBlastCommand(fastaOut, threads), stdout=PIPE, encoding='latin-1', bufsize=1024*1024) as blastProcess:
+            hits = univecHitTable(blastProcess.stdout)
+
+        if blastProcess.returncode != 0:
+            self.logger.error('blastn exited with code ' + str(blastProcess.returncode) + ' while screening ' + readgroupName)
+
+        self.trimUnivecHits(readgroupName, readgroupInput, hits)
+        return
 
-        call([self.args.get('bin', 'blastnbin'),
+    """ blastn command line screening query (a path, - for stdin) against univec, csv hits go to stdout """
+    def univecBlastCommand(self, query, threads):
+        return [self.args.get('bin', 'blastnbin'),
             '-task', 'blastn',
             '-reward', '1',
             '-penalty', '-4',
@@ -207,146 +592,87 @@ class barberShopObject:
             '-evalue', '700',
             '-searchsp', '1750000000000',
             '-db', self.barberUnivecDb,
-            '-query', fastaOut,
-            '-num_threads', '32',
-            '-out', univecOut,
+            '-query', query,
+            '-num_threads', str(threads),
             '-outfmt', '10 qseqid sseqid qstart qend length pident sstrand score',
             '-max_target_seqs', '1'
-        ], stdout=nullHandle)
+        ]
+
+    """ Trims univec hits (qseqid -> (qstart, qend)) off the reads of readgroupInput """
+    def trimUnivecHits(self, readgroupName, readgroupInput, hits):
+        outputPath = self.barberOutput + '/' + readgroupName + '.univec.fastq' + self.intermediateSuffix
+        minLength = self.args.getint('barbershop', 'minLengthForUnivecTrim')
 
-        #parse univec results
-        univecHits = defaultdict(dict)
-        with open(univecOut) as univecResults:
-            for i, line in enumerate(univecResults):
-                lineSplit = line.split(',')
-                univecHits[lineSplit[0]] = defaultdict(dict)
-                univecHits[lineSplit[0]]['begin'] = lineSplit[2]
-                univecHits[lineSplit[0]]['end'] = lineSplit[3]
-
-        outputPath = self.barberOutput + '/' + readgroupName + '.univec.fastq'
-        rejectPath = self.barberOutput + '/' + readgroupName + '.rejected.fastq'
-        rejectHandle = open(rejectPath, 'a')
-
-        outputHandle = open(outputPath, 'w')
-        inputHandle = open(readgroupInput, 'r')
         trimCount = 0
         trimDiscarded = 0
 
-        for name, seq, qual in readfq(inputHandle):
+        with compression.openOutput(outputPath, self.intermediateCodec) as outputHandle, \
+            rejects.rejectSink(self.rejectPath(readgroupName), self.rejectMode) as rejectSink:
 
-            #univec found?
-            if name in univecHits:
-                endPoint = int(univecHits[name]['begin'])
-                fromBeginning = int(univecHits[name]['begin'])
-                fromEnd = len(seq) - int(univecHits[name]['end'])
+            for ordinal, (name, seq, qual) in enumerate(fastx.fastqIter(readgroupInput, shortName=True)):
 
-                if fromBeginning <= 25 or fromEnd <= 25:
-                    seq = seq[:endPoint]
-                    qual = seq[:endPoint]
-                    trimCount += 1
+                #univec found?
+                hit = hits.get(name)
+                if hit is not None:
+                    seq, qual, trimmed = univecTrim(seq, qual, hit[0], hit[1])
+                    trimCount += trimmed
 
-            thisSeqLen = len(seq)
+                thisSeqLen = len(seq)
 
-            if thisSeqLen <= self.args.getint('barbershop', 'minLengthForUnivecTrim'):
-                rejectHandle.write('@' + name + ' UNIVEC-FRAG-TOO-SMALL \n')
-                rejectHandle.write(seq + '\n')
-                rejectHandle.write('+' + '\n')
-                rejectHandle.write(qual + '\n')
-                trimDiscarded += 1
-            else:
-                outputHandle.write('@' + name + '\n')
-                outputHandle.write(seq + '\n')
-                outputHandle.write('+' + '\n')
-                outputHandle.write(qual + '\n')
+                if thisSeqLen <= minLength:
+                    rejectSink.reject(ordinal, rejects.UNIVEC_FRAG_TOO_SMALL, name, seq, qual)
+                    trimDiscarded += 1
+                else:
+                    outputHandle.write('@' + name + '\n' + seq + '\n+\n' + qual + '\n')
 
         self.logger.debug('Univec based trims: ' + str(trimCount))
         self.logger.debug('Univec based rejects: ' + str(trimDiscarded))
-
-        outputHandle.close()
-        inputHandle.close()
         return
 
-    def qcChecker(self, readgroupName, readgroupInput):
-        outputPath = self.barberOutput + '/' + readgroupName + '.trimmed.fastq'
-        rejectPath = self.barberOutput + '/' + readgroupName + '.rejected.fastq'
-
-        perBaseQuality = []
-        perQualityLength = []
-
-        inputHandle = open(readgroupInput, 'r')
-        outputHandle = open(outputPath, 'w')
-        rejectHandle = open(rejectPath, 'w')
-        qualFile = open(self.barberOutput + '/' + readgroupName + '.quals.txt', 'w')
-
-        readsDropped = 0
-        readsCompressionRatioDropped = 0
-        readsSalvaged = 0
-        readsWritten = 0
-        #n, slen, qlen = 0, 0, 0
-        for name, seq, qual in readfq(inputHandle):
-
-
-            if self.args.getboolean('barbershop', 'checkCompressionRatio') is True:
-                thisCompressionRatio = compressionRatio(seq)
-                if ( thisCompressionRatio <= self.args.getfloat('barbershop', 'compressionRatioCutOff')):
-                    rejectHandle.write('@' + name + 'TRIMMER-COMPRESSION-RATIO (' + str(thisCompressionRatio) +')\n')
-                    rejectHandle.write(seq + '\n')
-                    rejectHandle.write('+' + '\n')
-                    rejectHandle.write(qual + '\n')
-                    readsDropped = readsDropped + 1
-                    readsCompressionRatioDropped += 1
-                    continue
-
-            #length only
-            if self.args.getboolean('barbershop', 'trimOnlyLength') is True:
-                if ( len(seq) >=  self.args.getint('barbershop', 'minLength')):
-                    outputHandle.write('@' + name + '\n')
-                    outputHandle.write(seq + '\n')
-                    outputHandle.write('+' + '\n')
-                    outputHandle.write(qual + '\n')
-                    readsWritten += 1
-                else:
-                    rejectHandle.write('@' + name + ' TRIMMER-TOO-SHORT \n')
-                    rejectHandle.write(seq + '\n')
-                    rejectHandle.write('+' + '\n')
-                    rejectHandle.write(qual + '\n')
-                    readsDropped = readsDropped + 1
-            else:
-
-                #get quality score and calcualte average quality
-                qualities = [ord(x) - 33 for x in qual.rstrip('\n')]
-                average_quality = sum(qualities) / len(qualities)
-
-                c = Counter(qualities)
-                dipSum = sum(v for k, v in c.items() if k < self.args.getint('barbershop','dipCheckTreshold'))
-                qualFile.write(str(average_quality) + '\t' + str(dipSum) + '\n')
-
-                if (average_quality >= self.args.getint('barbershop', 'minAverageQuality') and
-                dipSum < self.args.getint('barbershop', 'maxNumberOfDips') and
-                len(seq) >=  self.args.getint('barbershop', 'minLength')):
-                    outputHandle.write('@' + name + '\n')
-                    outputHandle.write(seq + '\n')
-                    outputHandle.write('+' + '\n')
-                    outputHandle.write(qual + '\n')
-                    readsWritten += 1
-                else:
-
-                    if self.args.getboolean('barbershop','salvageEnabled') and len(seq) > self.args.getint('barbershop','salvageLength'):
-                        outputHandle.write('@' + name + '\n')
-                        outputHandle.write(seq + '\n')
-                        outputHandle.write('+' + '\n')
-                        outputHandle.write(qual + '\n')
-                        readsSalvaged += 1
-                        readsWritten += 1
-                    else:
-                        rejectHandle.write('@' + name + ' TRIMMER-QUALITY-OR-LENGTH LEN: ' + str(len(seq)) + ' AVG_QUAL: ' + str(average_quality) + ' DIPSUM: ' + str(dipSum) + '  \n')
-                        rejectHandle.write(seq + '\n')
-                        rejectHandle.write('+' + '\n')
-                        rejectHandle.write(qual + '\n')
-                        readsDropped = readsDropped + 1
-
-        self.logger.debug('Trimmer quality control dropped reads: ' + str(readsDropped))
-        self.logger.debug('Trimmer quality control dropped because of compression ratio: ' + str(readsCompressionRatioDropped))
-        self.logger.debug('Trimmer quality control length-salvaged reads: ' + str(readsSalvaged))
-        self.logger.debug('Trimmer sum of reads written: ' + str(readsWritten))
+    """ Writes only the reads that share a k-mer with univec to fastaOut, returns how many were written """
+    def writeUnivecCandidates(self, readgroupInput, fastaOut):
+        screened = 0
+        candidates = 0
+
+        with open(fastaOut, 'w', 8388608, encoding='latin-1') as fastaHandle:
+            batch = []
+            for record in fastx.fastqIter(readgroupInput, shortName=True):
+                batch.append(record)
+                if len(batch) == kmerfilter.BATCH_SIZE:
+                    candidates += self.writeCandidateBatch(batch, fastaHandle)
+                    screened += len(batch)
+                    batch = []
+
+            if batch:
+                candidates += self.writeCandidateBatch(batch, fastaHandle)
+                screened += len(batch)
+
+        self.logger.debug('Univec prefilter candidates: ' + str(candidates) + ' out of ' + str(screened) + ' reads')
+        return candidates
+
+    def writeCandidateBatch(self, batch, fastaHandle):
+        hits = self.univecKmers.hasHits([seq for name, seq, qual in batch]).tolist()
+        for hit, (name, seq, qual) in zip(hits, batch):
+            if hit:
+                fastaHandle.write('>' + name + '\n' + seq + '\n')
+        return sum(hits)
+
+    """ Reject sink path of a read group without suffix, the suffix depends on the rejectSink mode """
+    def rejectPath(self, readgroupName):
+        return self.barberOutput + '/' + readgroupName + '.rejected'
+
+    def qcChecker(self, readgroupName, readgroupInput, threads):
+        outputPath = self.barberOutput + '/' + readgroupName + '.trimmed.fastq' + self.intermediateSuffix
+        summaryPath = self.barberOutput + '/' + readgroupName + '.quals.npz'
+
+        processes = min(trimmer.trimmerProcesses(self.args), threads)
+        self.logger.debug('Trimmer processes: ' + str(processes))
+
+        counters = trimmer.runTrimmer(readgroupInput, outputPath, self.rejectPath(readgroupName), summaryPath,
+            trimmer.trimmerSettings(self.args), self.intermediateCodec, processes, self.rejectMode)
+
+        self.logger.debug('Trimmer quality control dropped reads: ' + str(counters['readsDropped']))
+        self.logger.debug('Trimmer quality control dropped because of compression ratio: ' + str(counters['readsCompressionRatioDropped']))
+        self.logger.debug('Trimmer quality control length-salvaged reads: ' + str(counters['readsSalvaged']))
+        self.logger.debug('Trimmer sum of reads written: ' + str(counters['readsWritten']))
         return
@@ -9,7 +9,7 @@ import barbershop
 import pprint
 from art import *
 from cactusUtils import *
-from spike import spikeObject
+from spike import spikeObject, spikeCheckpointPath
 from discover import discoveryObject
 import logging
 
@@ -46,8 +46,11 @@ class lobbyBoy(object):
     def checkDirectoryOk(self):
         resultPathExisted = checkDirOrCreate(self.outputPath)
         if resultPathExisted is True:
+            #a resumed run continues in the results of the earlier one
+            if self.cargs.resume is True:
+                self.logger.info('Resuming, keeping the existing results folder')
             #if set to overwrite, drop directory drop directory and create again
-            if self.args.getboolean('advanced', 'overwriteOnExist') is False:
+            elif self.args.getboolean('advanced', 'overwriteOnExist') is False:
                 raise Exception('Output directory already eixsted')
             else:
                 #we now also need to check if we are going to remove it or not based on
@@ -74,10 +77,19 @@ class lobbyBoy(object):
         bs.performQC()
         return
 
+    """ A resumed run skips QC only when an earlier run got as far as a finished assembly pass """
+    def resumesAssembly(self):
+        if self.cargs.resume is False:
+            return False
+        if os.path.isfile(spikeCheckpointPath(self.outputPath, self.args)):
+            return True
+        self.logger.warning('No assembly checkpoint to resume from, running QC again')
+        return False
+
     """ Run assembly  """
     def assembly(self):
         spike = spikeObject(self.readGroups, self.outputPath, self.args)
-        assemblyFasta = spike.doCodonCloneAlignment()
+        assemblyFasta = spike.doCodonCloneAlignment(self.cargs.resume)
         self.discovery(assemblyFasta)
 
     def discovery(self, assemblyFasta):
@@ -125,6 +137,8 @@ def cactusInit():
                     help='Do not perform Assembly, will skip output directory removal', default=False)
     parser.add_argument('--skip_discovery', dest='skip_discovery', action='store_true',
                 help='Do not perform discovery, will skip output directory removal', default=False)
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                help='Continue the assembly after the last finished pass of an earlier run (QC is skipped when there is one), skips output directory removal', default=False)
 
     args = parser.parse_args()
 
@@ -149,7 +163,7 @@ def cactusInit():
     else:
         lb = lobbyBoy(config, args, logger)
 
-        if args.skip_qc is False:
+        if args.skip_qc is False and lb.resumesAssembly() is False:
             lb.runQC()
 
         if args.skip_assembly is False:
@@ -2,9 +2,16 @@
 # -*- coding: utf-8 -*-
 import shutil
 import os
-from itertools import groupby
+import math
+import errno
+import fcntl
 from collections import defaultdict
 import zlib
+import hashlib
+import fastx
+import fastxindex
+import consensus
+import seqops
 
 def compressionRatio(seq):
     bseq = bytes(seq, 'UTF-8')
@@ -12,98 +19,24 @@ def compressionRatio(seq):
     return complexity
 
 def gapClipper(seq):
-    maxPosteriorGapLength = 10
-    maxPosteriorGapIslandLength = 6
-
-    nucl = [ 'A', 'C', 'T', 'G', 'a', 'c', 't', 'g']
-    replacer = '-'
-    pos = 0
-    onlyGaps = True
-    posteriorGapStart = False
-    posteriorGapLength = 0
-    posteriorGapGapBoundary = False
-    posteriorGapIslandLength = 0
-
-    for letter in seq:
-        if onlyGaps == True:
-            if letter in nucl:
-                onlyGaps = False
-                posteriorGapStart = pos
-        else:
-            if letter == '-':
-                posteriorGapLength += 1
-            else:
-                posteriorGapGapBoundary = pos + 1
-                posteriorGapIslandLength += 1
-
-            if posteriorGapIslandLength > maxPosteriorGapIslandLength:
-                return seq
-
-            if posteriorGapLength > maxPosteriorGapLength:
-                islandLength = posteriorGapGapBoundary - posteriorGapStart
-                if islandLength == 0:
-                    islandLength = 1
-
-                if posteriorGapStart == 0:
-                    mutated =  replacer * islandLength + seq[islandLength:]
-                else:
-                    mutated =  seq[:posteriorGapStart] + replacer * islandLength + seq[posteriorGapGapBoundary:]
-
-                return mutated
-        pos += 1
-
-    return seq
+    return seqops.gapClipper(seq)
 
 def revcomp(dna):
-    bases = 'ATGCN-TACGN-'
-    complement_dict = {bases[i]:bases[i+6] for i in range(6)}
-    dna = reversed(dna)
-    result_as_list = None
-    result_as_list = [complement_dict[base] for base in dna]
-    return ''.join(result_as_list)
+    return seqops.revcomp(dna)
 
 def fastaIter(fastaName):
-    fh = open(fastaName)
-    faiter = (x[1] for x in groupby(fh, lambda line: line[0] == ">"))
-    for header in faiter:
-        header = header.__next__()[1:].strip()
-        seq = "".join(s.strip() for s in faiter.__next__())
-        yield header, seq
+    return fastx.fastaIter(fastaName)
 
 def qualIter(qualName):
-    fh = open(qualName)
-    faiter = (x[1] for x in groupby(fh, lambda line: line[0] == ">"))
-    for header in faiter:
-        header = header.__next__()[1:].strip()
-        qual = " ".join(s.strip() for s in faiter.__next__())
-        yield header, qual.split(' ')
+    return fastx.qualIter(qualName)
 
 def fqIter(fqName):
-    f = open(fqName)
-    lines = f.readlines()
-    f.close()
-    records = len(lines)
-    lastLine = False
-    index = 0
-
-    while lastLine == False:
-        try:
-            name = lines[index]
-            seq = lines[index + 1]
-            qual = lines[index + 3]
-            index = index + 4
-        except IndexError:
-            print('index error for index' + str(index))
-            sys.exit()
-        if index >= records:
-            lastLine = True
-        else:
-            #check if empty
-            content = lines[index].strip()
-            if not content:
-                lastLine = True
-
-        yield name[1:].strip(),seq,qual
+    return fastx.fastqIter(fqName)
+
+""" Number of records in a FASTA/FASTQ file, taken from its (cached) index """
+def countFasta(fastaName):
+    with fastxindex.indexFor(fastaName) as index:
+        return len(index)
 
 def parseAce(aceName):
 
@@ -126,108 +59,118 @@ def parseAce(aceName):
     return contigComposition
 
 def replaceLeadingAndTrailingGaps(seq, replaceChar = '~'):
-    leadingRemoved = seq.lstrip('-actg')
-    trailingRemoved = seq.rstrip('-actg')
-    leadingN = len(seq) - len(leadingRemoved)
-    trailingN = len(seq) - len(trailingRemoved)
-    mutatedSeq = seq[:leadingN].replace('-', replaceChar) + seq[leadingN:]
-    trailCut = len(mutatedSeq) - trailingN
-    mutatedSeq = mutatedSeq[:trailCut] + replaceChar * trailingN
-    return mutatedSeq.upper()
+    return seqops.replaceLeadingAndTrailingGaps(seq, replaceChar)
 
 def cactusConsensus(seqCol, idx):
-    iupac = dict()
-
-    iupac['A'] = 'A'
-    iupac['C'] = 'C'
-    iupac['T'] = 'T'
-    iupac['G'] = 'G'
-
-    iupac['R'] = 'AG'
-    iupac['Y'] = 'CT'
-    iupac['S'] = 'CG'
-    iupac['W'] = 'AT'
-    iupac['K'] = 'GT'
-    iupac['M'] = 'AC'
-    iupac['B'] = 'CGT'
-    iupac['D'] = 'AGT'
-    iupac['H'] = 'ACT'
-    iupac['V'] = 'ACG'
-    iupac['N'] = 'ACGT'
-    iupac['AG'] = 'R'
-    iupac['CT'] = 'Y'
-    iupac['CG'] = 'S'
-    iupac['AT'] = 'W'
-    iupac['GT'] = 'K'
-    iupac['AC'] = 'M'
-    iupac['CGT'] = 'B'
-    iupac['AGT'] = 'D'
-    iupac['ACT'] = 'H'
-    iupac['ACG'] = 'V'
-    iupac['ACGT'] = 'N'
-
-    n = len(seqCol[0])
-    allowed = 'TGCAN-'
-    profile = { 'T':[0]*n,'G':[0]*n ,'C':[0]*n,'A':[0]*n, 'N':[0]*n, '-':[0]*n }
-    consensus = ''
-
-    for seq in seqCol:
-        for i, char in enumerate(seq):
-            if char in allowed:
-                profile[char][i] += 1
-
-    for i in range(n):
-        d = {N:profile[N][i] for N in ['T','G','C','A', '-', 'N']}
-        m = max(d.values())
-        l = [N for N in ['T','G','C','A', '-', 'N'] if d[N] == m]
-
-        if(m == 0):
+    return consensus.cactusConsensus(seqCol, idx)
+
+""" SHA-256 hex digest over the contents of paths and any extra strings, used as a cache key """
+def fileDigest(paths, extra = []):
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as handle:
+            for block in iter(lambda: handle.read(1024*1024), b''):
+                digest.update(block)
+        digest.update(b'\0')
+
+    for value in extra:
+        digest.update(str(value).encode('utf-8'))
+        digest.update(b'\0')
+
+    return digest.hexdigest()
+
+""" Number of cores this process may run on, limited by the cpu affinity and a cgroup cpu quota """
+def availableCores():
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+
+    quota = cgroupCpuQuota()
+    if quota is not None:
+        cores = min(cores, quota)
+    return max(1, cores)
+
+""" Cores granted by the cgroup cpu quota (v2 cpu.max or v1 cfs quota), rounded up, None without a quota """
+def cgroupCpuQuota(root = '/sys/fs/cgroup'):
+    try:
+        with open(root + '/cpu.max') as handle:
+            quota, period = handle.read().split()[:2]
+    except (OSError, ValueError):
+        try:
+            with open(root + '/cpu/cpu.cfs_quota_us') as handle:
+                quota = handle.read().strip()
+            with open(root + '/cpu/cpu.cfs_period_us') as handle:
+                period = handle.read().strip()
+        except OSError:
+            return None
+
+    if quota == 'max' or int(quota) <= 0 or int(period) <= 0:
+        return None
+    return math.ceil(int(quota) / int(period))
+
+#linux ioctl that shares the extents of one file with another (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+STAGING_COPY = 'copy'
+STAGING_AUTO = 'auto'
+
+""" Places source at destination without copying data where the filesystem allows it.
+    In auto mode a reflink and an in-kernel copy_file_range are tried in that order. A source
+    the pipeline owns is hardlinked first and moved before falling back to a full copy, any
+    other source (user input) is never hardlinked, so writes to the staged file can not reach
+    it. The destination is replaced atomically. Returns the method that was used. """
+def stageFile(source, destination, mode = STAGING_AUTO, owned = False):
+    if mode == STAGING_COPY:
+        shutil.copyfile(source, destination)
+        return STAGING_COPY
+
+    tmpDestination = destination + '.' + str(os.getpid()) + '.staging'
+
+    stagers = [('reflink', _reflink), ('copy_file_range', _copyFileRange)]
+    if owned:
+        stagers.insert(0, ('hardlink', _hardlink))
+
+    for method, stager in stagers:
+        try:
+            stager(source, tmpDestination)
+        except OSError:
+            if os.path.lexists(tmpDestination):
+                os.unlink(tmpDestination)
             continue
-        elif len(l) > 1:
-            #remove - from here to cooerce nucleotide assignment
-            if '-' in l:
-                l.remove('-')
-            c = ''.join(sorted(l))
-            if c in iupac.keys():
-                consensus += iupac[c]
-            else:
-                consensus += 'N'
-        else:
-            consensus += l[0]
-
-    degappedConsensus = consensus.replace('-', '')
-    return degappedConsensus
-
-def readfq(fp):
-    last = None
-    while True:
-        if not last:
-            for l in fp:
-                if l[0] in '>@':
-                    last = l[:-1]
-                    break
-        if not last: break
-        name, seqs, last = last[1:].partition(" ")[0], [], None
-        for l in fp:
-            if l[0] in '@+>':
-                last = l[:-1]
-                break
-            seqs.append(l[:-1])
-        if not last or last[0] != '+':
-            yield name, ''.join(seqs), None
-            if not last: break
-        else:
-            seq, leng, seqs = ''.join(seqs), 0, []
-            for l in fp:
-                seqs.append(l[:-1])
-                leng += len(l) - 1
-                if leng >= len(seq):
-                    last = None
-                    yield name, seq, ''.join(seqs);
-                    break
-            if last:
-                yield name, seq, None
-                break
+        os.replace(tmpDestination, destination)
+        return method
+
+    if owned:
+        try:
+            os.replace(source, destination)
+            return 'rename'
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    shutil.copyfile(source, destination)
+    return STAGING_COPY
+
+def _hardlink(source, destination):
+    os.link(source, destination)
+
+def _reflink(source, destination):
+    with open(source, 'rb') as sourceHandle, open(destination, 'wb') as destinationHandle:
+        fcntl.ioctl(destinationHandle.fileno(), FICLONE, sourceHandle.fileno())
+
+def _copyFileRange(source, destination):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range not available')
+
+    with open(source, 'rb') as sourceHandle, open(destination, 'wb') as destinationHandle:
+        remaining = os.fstat(sourceHandle.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(sourceHandle.fileno(), destinationHandle.fileno(), remaining)
+            if copied == 0:
+                raise OSError(errno.EIO, 'copy_file_range stopped early')
+            remaining -= copied
+
 """ Checks if dir exists, if not creates it (will return false), if it does, return True """
 def checkDirOrCreate(dirPath):
     dirExists = os.path.isdir(dirPath)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import io
+import gzip
+import zlib
+import struct
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+""" compression.py: Transparent compressed input and compressed intermediate files
+
+    Input compression is detected from the magic bytes, not the file name. BGZF
+    (bgzip) files are inflated block-parallel on a thread pool, plain gzip and
+    zstd are decompressed on a read-ahead thread so decompression overlaps with
+    parsing. zlib and zstandard release the GIL, so both use extra cores.
+"""
+
+CODEC_NONE = 'none'
+CODEC_GZIP = 'gzip'
+CODEC_BGZIP = 'bgzip'
+CODEC_ZSTD = 'zstd'
+
+SUFFIXES = {CODEC_NONE: '', CODEC_GZIP: '.gz', CODEC_BGZIP: '.gz', CODEC_ZSTD: '.zst'}
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+BGZF_HEADER = struct.Struct('<4sIBBH')
+
+CHUNK_SIZE = 1024*1024*4
+READ_AHEAD = 8
+WORKERS = min(8, os.cpu_count() or 1)
+
+class chunkReader(io.RawIOBase):
+
+    def __init__(self, chunks, onClose = None):
+        self.chunks = chunks
+        self.onClose = onClose
+        self.current = memoryview(b'')
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = len(b)
+        n = 0
+        while n < size:
+            if self.pos >= len(self.current):
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.current = memoryview(chunk)
+                self.pos = 0
+                continue
+
+            take = min(size - n, len(self.current) - self.pos)
+            b[n:n + take] = self.current[self.pos:self.pos + take]
+            self.pos += take
+            n += take
+        return n
+
+    def close(self):
+        if not self.closed:
+            if hasattr(self.chunks, 'close'):
+                self.chunks.close()
+            if self.onClose is not None:
+                self.onClose()
+        super().close()
+
+""" Detects the codec of a file from its first bytes """
+def detectCompression(path):
+    with open(path, 'rb') as handle:
+        head = handle.read(BGZF_HEADER.size + 4)
+
+    if head[:4] == ZSTD_MAGIC:
+        return CODEC_ZSTD
+    if head[:2] == GZIP_MAGIC:
+        #BGZF sets FEXTRA and has a 'BC' subfield first
+        if len(head) >= 16 and head[3] & 4 and head[12:14] == b'BC':
+            return CODEC_BGZIP
+        return CODEC_GZIP
+    return CODEC_NONE
+
+def suffixFor(codec):
+    if codec not in SUFFIXES:
+        raise ValueError('Unknown compression codec: ' + str(codec))
+    return SUFFIXES[codec]
+
+""" Returns the first existing path out of basePath and basePath with a compression suffix """
+def resolvePath(basePath):
+    for suffix in ('', '.gz', '.zst'):
+        if os.path.isfile(basePath + suffix):
+            return basePath + suffix
+    return basePath
+
+""" Opens path for binary reading, decompressing transparently """
+def openInput(path, workers = WORKERS):
+    codec = detectCompression(path)
+
+    if codec == CODEC_NONE:
+        return open(path, 'rb', buffering=0)
+
+    if codec == CODEC_BGZIP:
+        handle = open(path, 'rb')
+        return chunkReader(_parallelInflate(_bgzfBlocks(handle), workers), handle.close)
+
+    if codec == CODEC_GZIP:
+        return _readAheadReader(_gzipChunks(path))
+
+    _requireZstandard()
+    return _readAheadReader(_zstdChunks(path))
+
+""" Opens path for text writing with the given codec, level 1 favours speed over ratio """
+def openOutput(path, codec = CODEC_NONE, level = 1, buffering = 8388608):
+    if codec == CODEC_NONE:
+        return open(path, 'w', buffering, encoding='latin-1')
+
+    if codec in (CODEC_GZIP, CODEC_BGZIP):
+        return io.TextIOWrapper(io.BufferedWriter(gzip.open(path, 'wb', compresslevel=level), buffering), encoding='latin-1')
+
+    if codec == CODEC_ZSTD:
+        _requireZstandard()
+        compressor = zstandard.ZstdCompressor(level=level, threads=-1)
+        writer = compressor.stream_writer(open(path, 'wb'))
+        return io.TextIOWrapper(io.BufferedWriter(writer, buffering), encoding='latin-1')
+
+    raise ValueError('Unknown compression codec: ' + str(codec))
+
+def _requireZstandard():
+    if zstandard is None:
+        raise ImportError('Reading or writing zstd files requires the zstandard module')
+
+""" Yields the raw deflate payload and uncompressed size of every BGZF block """
+def _bgzfBlocks(handle):
+    while True:
+        header = handle.read(BGZF_HEADER.size)
+        if not header:
+            return
+        if len(header) < BGZF_HEADER.size:
+            raise ValueError('Truncated BGZF block header')
+
+        magic, mtime, xfl, os_, xlen = BGZF_HEADER.unpack(header)
+        if magic[:2] != GZIP_MAGIC or not magic[3] & 4:
+            raise ValueError('Not a BGZF block')
+
+        extra = handle.read(xlen)
+        blockSize = None
+        pos = 0
+        while pos + 4 <= len(extra):
+            subfield = extra[pos:pos + 2]
+            subLength = struct.unpack_from('<H', extra, pos + 2)[0]
+            if subfield == b'BC':
+                blockSize = struct.unpack_from('<H', extra, pos + 4)[0] + 1
+            pos += 4 + subLength
+
+        if blockSize is None:
+            raise ValueError('BGZF block without BC subfield')
+
+        body = handle.read(blockSize - BGZF_HEADER.size - xlen)
+        crc, uncompressedSize = struct.unpack_from('<II', body, len(body) - 8)
+        yield body[:-8], uncompressedSize
+
+def _inflate(block):
+    payload, uncompressedSize = block
+    data = zlib.decompress(payload, -15)
+    if len(data) != uncompressedSize:
+        raise ValueError('Corrupt BGZF block')
+    return data
+
+""" Inflates blocks on a thread pool while preserving their order """
+def _parallelInflate(blocks, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for block in blocks:
+            pending.append(executor.submit(_inflate, block))
+            if len(pending) >= workers * READ_AHEAD:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+def _gzipChunks(path):
+    with gzip.open(path, 'rb') as handle:
+        while True:
+            chunk = handle.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+def _zstdChunks(path):
+    with open(path, 'rb') as handle:
+        reader = zstandard.ZstdDecompressor().stream_reader(handle, read_size=CHUNK_SIZE, read_across_frames=True)
+        while True:
+            chunk = reader.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+""" Runs a chunk generator on a background thread, handing chunks over through a bounded queue """
+def _readAheadReader(chunks):
+    chunkQueue = queue.Queue(READ_AHEAD)
+    stop = threading.Event()
+    end = object()
+
+    def produce():
+        try:
+            for chunk in chunks:
+                while not stop.is_set():
+                    try:
+                        chunkQueue.put(chunk, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            chunkQueue.put(end)
+        except Exception as e:
+            chunkQueue.put(e)
+        finally:
+            chunks.close()
+
+    def consume():
+        while True:
+            item = chunkQueue.get()
+            if item is end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def shutdown():
+        stop.set()
+        #unblock the producer if it is waiting on a full queue
+        while producer.is_alive():
+            try:
+                chunkQueue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    return chunkReader(consume(), shutdown)
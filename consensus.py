@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+
+""" consensus.py: Vectorized majority consensus over gapped alignments
+
+    Alignments are encoded as uint8 symbol codes, counted per column with a
+    single bincount and resolved through a lookup table indexed by the bitmask
+    of the symbols tied for the maximum count in that column.
+"""
+
+IUPAC = {
+    'A': 'A', 'C': 'C', 'T': 'T', 'G': 'G',
+    'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+    'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT',
+    'AG': 'R', 'CT': 'Y', 'CG': 'S', 'AT': 'W', 'GT': 'K', 'AC': 'M',
+    'CGT': 'B', 'AGT': 'D', 'ACT': 'H', 'ACG': 'V', 'ACGT': 'N',
+}
+
+#symbol order determines the code of each symbol and its bit in the tie mask
+SYMBOLS = 'TGCA-N'
+IGNORED = len(SYMBOLS)
+
+def _buildEncoder():
+    encoder = np.full(256, IGNORED, dtype=np.uint8)
+    for code, symbol in enumerate(SYMBOLS):
+        encoder[ord(symbol)] = code
+    return encoder
+
+""" Resolves every possible set of tied symbols to its consensus character(s) """
+def _buildResolver():
+    resolver = []
+    for mask in range(1 << len(SYMBOLS)):
+        tied = [symbol for code, symbol in enumerate(SYMBOLS) if mask & (1 << code)]
+
+        if len(tied) == 0:
+            resolver.append('')
+        elif len(tied) > 1:
+            #remove - from here to cooerce nucleotide assignment
+            if '-' in tied:
+                tied.remove('-')
+            resolver.append(IUPAC.get(''.join(sorted(tied)), 'N'))
+        else:
+            resolver.append(tied[0])
+
+    return resolver
+
+ENCODER = _buildEncoder()
+RESOLVER = _buildResolver()
+BITS = (1 << np.arange(len(SYMBOLS), dtype=np.uint8)).astype(np.uint8)
+
+def _asBytes(seq):
+    if isinstance(seq, str):
+        return seq.encode('latin-1')
+    return bytes(seq)
+
+""" Encodes all alignments into flat (code, global column) arrays, returns those plus the column offset of every alignment """
+def encodeAlignments(alignments):
+    seqBytes = []
+    seqColumnOffsets = []
+    columnOffsets = [0]
+
+    for seqCol in alignments:
+        encoded = [_asBytes(seq) for seq in seqCol]
+        n = len(encoded[0])
+        for seq in encoded:
+            if len(seq) > n:
+                raise ValueError('Alignment contains a sequence longer than its first sequence')
+            seqBytes.append(seq)
+            seqColumnOffsets.append(columnOffsets[-1])
+        columnOffsets.append(columnOffsets[-1] + n)
+
+    lengths = np.fromiter((len(seq) for seq in seqBytes), dtype=np.int64, count=len(seqBytes))
+    codes = ENCODER[np.frombuffer(b''.join(seqBytes), dtype=np.uint8)]
+
+    seqStarts = np.cumsum(lengths) - lengths
+    columns = np.arange(len(codes), dtype=np.int64)
+    columns += np.repeat(np.asarray(seqColumnOffsets, dtype=np.int64) - seqStarts, lengths)
+
+    return codes, columns, np.asarray(columnOffsets, dtype=np.int64)
+
+""" Counts every symbol per column, returns a (len(SYMBOLS), nColumns) matrix """
+def profileCounts(codes, columns, nColumns):
+    valid = codes != IGNORED
+    flat = codes[valid].astype(np.int64) * nColumns + columns[valid]
+    counts = np.bincount(flat, minlength=len(SYMBOLS) * nColumns)
+    return counts.reshape(len(SYMBOLS), nColumns)
+
+""" Bitmask per column of the symbols that share the maximum count, 0 for empty columns """
+def tieMasks(counts):
+    maxCounts = counts.max(axis=0)
+    tied = (counts == maxCounts) & (maxCounts > 0)
+    return np.bitwise_or.reduce(tied * BITS[:, None], axis=0)
+
+""" Consensus of many alignments in one call, every alignment is a collection of equally long (gapped) sequences """
+def batchConsensus(alignments):
+    alignments = [seqCol for seqCol in alignments]
+    if len(alignments) == 0:
+        return []
+
+    codes, columns, columnOffsets = encodeAlignments(alignments)
+    masks = tieMasks(profileCounts(codes, columns, int(columnOffsets[-1]))).tolist()
+
+    resolve = RESOLVER.__getitem__
+    consensi = []
+    for i in range(len(alignments)):
+        columnMasks = masks[columnOffsets[i]:columnOffsets[i + 1]]
+        consensi.append(''.join(map(resolve, columnMasks)).replace('-', ''))
+
+    return consensi
+
+def cactusConsensus(seqCol, idx = None):
+    return batchConsensus([seqCol])[0]
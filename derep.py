@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import fastx
+import compression
+import rejects
+
+""" derep.py: Streaming exact dereplication of FASTQ files
+
+    Every sequence is uppercased and hashed (optionally the smaller of the
+    sequence and its reverse complement, so both strands collapse together).
+    The first record of every distinct sequence is written straight away, later
+    copies only bump its abundance, so the input is read exactly once.
+"""
+
+DIGEST_SIZE = 16
+COMPLEMENT = bytes.maketrans(b'ACGTUNRYSWKMBDHV', b'TGCAANYRSWMKVHDB')
+
+STRAND_PLUS = 'plus'
+STRAND_BOTH = 'both'
+
+def sequenceKey(seq, bothStrands = False):
+    seq = seq.upper()
+    if bothStrands:
+        reverseComplement = seq.translate(COMPLEMENT)[::-1]
+        if reverseComplement < seq:
+            seq = reverseComplement
+    return hashlib.blake2b(seq, digest_size=DIGEST_SIZE).digest()
+
+""" Dereplicates inputPath into outputPath, returns a list of [name, abundance] per kept record in output order,
+    removed copies are passed to rejectSink when given """
+def dereplicate(inputPath, outputPath, codec = compression.CODEC_NONE, bothStrands = False, rejectSink = None):
+    kept = []
+    with compression.openOutput(outputPath, codec) as outputHandle:
+        fastx.writeFastq(outputHandle, dereplicateStream(fastx.fastqIter(inputPath, shortName=True), bothStrands, rejectSink, kept))
+    return kept
+
+""" Yields the first copy of every sequence in a record stream, [name, abundance] of every yielded record
+    is appended to kept and the abundance keeps counting until the stream is exhausted """
+def dereplicateStream(records, bothStrands = False, rejectSink = None, kept = None):
+    centroids = {}
+
+    for ordinal, (name, seq, qual) in enumerate(records):
+        key = sequenceKey(seq.encode('latin-1'), bothStrands)
+        centroid = centroids.get(key)
+
+        if centroid is None:
+            centroid = [name, 1]
+            centroids[key] = centroid
+            if kept is not None:
+                kept.append(centroid)
+            yield name, seq, qual
+        else:
+            centroid[1] += 1
+            if rejectSink is not None:
+                rejectSink.drop(ordinal, rejects.DEREP_DUPLICATE)
+
+def writeAbundances(kept, abundancePath):
+    with open(abundancePath, 'w', encoding='latin-1') as abundanceHandle:
+        for name, abundance in kept:
+            abundanceHandle.write(name + '\t' + str(abundance) + '\n')
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+from collections import Counter
+import fastx
+import compression
+import kmerfilter
+import rejects
+
+""" diginorm.py: Digital normalization of FASTQ files to cap read depth
+
+    Reads are streamed in order, a read is kept when the median count of its
+    canonical k-mers is below the target depth, and only kept reads add their
+    k-mers to the counts. Counts live in a count-min sketch: a fixed number of
+    tables of one byte saturating counters, so memory is bounded by the sketch
+    size and not by the number of distinct k-mers. Collisions can only raise a
+    count, so low-depth targets are never dropped because of the sketch.
+"""
+
+DEFAULT_K = 20
+MAX_K = 32
+DEFAULT_DEPTH = 20
+DEFAULT_TABLES = 4
+DEFAULT_TABLE_BITS = 24
+MAX_COUNT = 255
+BATCH_SIZE = 10000
+
+#odd 64 bit multipliers, one multiplicative hash per table
+MULTIPLIERS = np.array([
+    0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93,
+    0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53, 0x94D049BB133111EB, 0xBF58476D1CE4E5B9,
+], dtype=np.uint64)
+
+class depthSketch:
+
+    def __init__(self, k = DEFAULT_K, tables = DEFAULT_TABLES, tableBits = DEFAULT_TABLE_BITS):
+        if k < 1 or k > MAX_K:
+            raise ValueError('k-mer size must be between 1 and ' + str(MAX_K))
+        if tables < 1 or tables > len(MULTIPLIERS):
+            raise ValueError('number of sketch tables must be between 1 and ' + str(len(MULTIPLIERS)))
+        if tableBits < 1 or tableBits > 32:
+            raise ValueError('sketch table bits must be between 1 and 32')
+
+        self.k = k
+        self.tables = tables
+        self.tableBits = tableBits
+        self.counts = np.zeros(tables << tableBits, dtype=np.uint8)
+
+    """ Canonical k-mers of a batch hashed into the sketch, one row per table, plus the per read column ranges """
+    def batchSlots(self, seqs):
+        canonical, starts = kmerfilter.canonicalKmers(seqs, self.k)
+
+        slots = np.empty((self.tables, len(canonical)), dtype=np.int64)
+        shift = np.uint64(64 - self.tableBits)
+        for table in range(self.tables):
+            slots[table] = (canonical * MULTIPLIERS[table]) >> shift
+            slots[table] += table << self.tableBits
+
+        bounds = np.append(starts, len(canonical))
+        return slots, bounds
+
+    """ Median estimated count of the k-mers in slots, 0 for reads without k-mers """
+    def medianCount(self, slots):
+        if slots.shape[1] == 0:
+            return 0
+        counts = np.sort(self.counts[slots].min(axis=0))
+        return int(counts[len(counts) // 2])
+
+    def add(self, slots):
+        counts = self.counts[slots]
+        np.add(counts, counts < MAX_COUNT, out=counts, casting='unsafe')
+        self.counts[slots] = counts
+
+    """ Per read keep flags for a batch, kept reads are added to the sketch before the next read is judged """
+    def normalizeBatch(self, seqs, depth):
+        slots, bounds = self.batchSlots(seqs)
+        keep = []
+        medians = []
+        for i in range(len(seqs)):
+            readSlots = slots[:, bounds[i]:bounds[i + 1]]
+            median = self.medianCount(readSlots)
+            medians.append(median)
+            if median < depth:
+                self.add(readSlots)
+                keep.append(True)
+            else:
+                keep.append(False)
+        return keep, medians
+
+    """ Size of the sketch in bytes """
+    def __len__(self):
+        return len(self.counts)
+
+""" Normalizes inputPath into outputPath, dropped reads go to rejectSink, returns (kept, dropped) """
+def normalize(inputPath, outputPath, rejectSink, codec = compression.CODEC_NONE, k = DEFAULT_K, depth = DEFAULT_DEPTH,
+    tables = DEFAULT_TABLES, tableBits = DEFAULT_TABLE_BITS):
+
+    counts = Counter({'kept': 0, 'dropped': 0})
+    with compression.openOutput(outputPath, codec) as outputHandle:
+        fastx.writeFastq(outputHandle, normalizeStream(fastx.fastqIter(inputPath, shortName=True), rejectSink, counts,
+            k, depth, tables, tableBits))
+
+    return counts['kept'], counts['dropped']
+
+""" Yields the records of a stream that are kept, counts gets the number of kept and dropped reads """
+def normalizeStream(records, rejectSink, counts, k = DEFAULT_K, depth = DEFAULT_DEPTH, tables = DEFAULT_TABLES,
+    tableBits = DEFAULT_TABLE_BITS):
+
+    if depth < 1 or depth >= MAX_COUNT:
+        raise ValueError('normalization depth must be between 1 and ' + str(MAX_COUNT - 1))
+
+    sketch = depthSketch(k, tables, tableBits)
+    firstOrdinal = 0
+
+    def judge(batch):
+        keep, medians = sketch.normalizeBatch([seq for name, seq, qual in batch], depth)
+        for i, (isKept, median, record) in enumerate(zip(keep, medians, batch)):
+            if isKept:
+                counts['kept'] += 1
+                yield record
+            else:
+                counts['dropped'] += 1
+                rejectSink.reject(firstOrdinal + i, rejects.DIGINORM_DEPTH, record[0], record[1], record[2], median)
+
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == BATCH_SIZE:
+            yield from judge(batch)
+            firstOrdinal += len(batch)
+            batch = []
+
+    if batch:
+        yield from judge(batch)
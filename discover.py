@@ -10,6 +10,9 @@ import json
 import configparser
 import socket
 from cactusUtils import *
+import fastx
+import fastxindex
+import scheduler
 from collections import Counter
 from collections import defaultdict
 import argparse
@@ -194,7 +197,7 @@ class discoveryObject:
         return
 
     def incomingCheck(self):
-        fa = fastaIter(self.assemblyFasta)
+        fa = fastx.fastaIter(self.assemblyFasta)
         assemblyCopyHandle = open(self.assemblyCopy, 'w')
         assemblyRejectHandle = open(self.assemblyReject, 'w')
         count = 0
@@ -259,7 +262,7 @@ class discoveryObject:
             nThreadsPerWorker = self.args.getint('discovery', 'threadShapeFactor')
             self.logger.debug('nThreadsPerWorker ' +str(nThreadsPerWorker))
 
-        processes = [Popen([self.args.get('bin', 'blastnbin'),
+        jobs = [scheduler.job('blastn thread ' + str(i), [self.args.get('bin', 'blastnbin'),
                             '-query',  self.threadStore + '/results_thread_' + str(i)  + str('.fasta'),
                             '-db',  self.args.get(profile, 'db'),
                             '-out',self.threadStore + '/results_thread_' + str(i)  + str('.txt'),
@@ -277,25 +280,13 @@ class discoveryObject:
                             '-culling_limit', self.args.get(profile, 'culling_limit'),
                             '-soft_masking', 'true',
                             '-outfmt', '0'
-                            ], stdout=PIPE,
-                       bufsize=1, close_fds=True,
-                       universal_newlines=True)
+                            ], nThreadsPerWorker)
                  for i in range( int(len(files)))]
 
         #print( str(len(files)) + ' * '  + self.args.get('discovery', 'threadShapeFactor')  + ' threads spun up.')
 
-        self.logger.debug(str(len(files)) + ' * '  + self.args.get('discovery', 'threadShapeFactor')  + ' threads spun up.')
-        tLeft = len(files)
-
-        while processes:#
-            for p in processes[:]:
-                if p.poll() is not None: # process ended
-                    tLeft = tLeft - 1
-                    #print('Threads left' + str(tLeft))
-                    self.logger.debug('Thread groups left: ' + str(tLeft))
-                    processes.remove(p)
-
-            time.sleep(1)
+        self.logger.debug(str(len(files)) + ' * '  + str(nThreadsPerWorker)  + ' threads queued.')
+        scheduler.runJobs(jobs, logger=self.logger)
 
         self.resultPileup(profile, files)
 
@@ -321,7 +312,8 @@ class discoveryObject:
 
     def splitInput(self):
         fasta = self.assemblyFasta
-        nSeq = self.countFasta(fasta)
+        fastaIndex = fastxindex.indexFor(fasta)
+        nSeq = len(fastaIndex)
         nThreads = self.args.getint('discovery', 'threads')
         threadShape = self.args.get('discovery', 'threadShape')
 
@@ -331,17 +323,6 @@ class discoveryObject:
             nThreads = int(self.args.getint('discovery', 'threads') / self.args.getint('discovery', 'threadShapeFactor'))
             nSeqPerCore = math.ceil(nSeq / nThreads)
 
-        seqLib = defaultdict(dict)
-        fiter = fastaIter(fasta)
-        seqId = 0
-
-        for ff in fiter:
-            headerStr, seq = ff
-            seqLib[seqId] = dict()
-            seqLib[seqId]['name'] = headerStr
-            seqLib[seqId]['seq'] = seq
-            seqId += 1
-
         threadFiles = defaultdict(dict)
         threadFilesTxt = defaultdict(dict)
         for n in range(nThreads):
@@ -349,15 +330,9 @@ class discoveryObject:
             threadFilesTxt[n]['query'] =   self.threadStore + '/results_thread_' + str(n) + str('.fasta')
             threadFilesTxt[n]['result'] =   self.threadStore + '/results_thread_' + str(n) + str('.txt')
 
-        seqListSorted = sorted(seqLib, key=lambda x: (len(seqLib[x]['seq'])), reverse=True)
-
         currThreadFile = 0
-        for seqKeyId in seqListSorted:
-            seqName = seqLib[seqKeyId]['name']
-            seqData = seqLib[seqKeyId]['seq']
-
-            threadFiles[currThreadFile].write('>' + seqName + '\n')
-            threadFiles[currThreadFile].write( seqData + '\n')
+        for seqKeyId in fastaIndex.byLength().tolist():
+            fastaIndex.writeFasta(seqKeyId, threadFiles[currThreadFile])
             currThreadFile += 1
 
             if(currThreadFile == nThreads):
@@ -366,12 +341,8 @@ class discoveryObject:
         for n in range(nThreads):
             threadFiles[n].close()
 
+        fastaIndex.close()
         return threadFilesTxt
 
     def countFasta(self, fasta):
-        nSeq = 0
-        fiter = fastaIter(fasta)
-        for ff in fiter:
-            nSeq += 1
-
-        return nSeq
+        return countFasta(fasta)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" fastx.py: Streaming, block buffered FASTA/FASTQ/phrap .qual parsing
+
+    Files are read in fixed size blocks into one reused buffer and split on
+    newlines per block, so memory use stays constant regardless of file size.
+    Records are produced lazily. By default names and sequences are returned as
+    str, pass raw = True to get the undecoded bytes instead. Compressed input
+    (gzip, bgzip, zstd) is decompressed transparently. Instead of a path an
+    open binary stream (a pipe from an external tool) can be read as well.
+"""
+
+import os
+import compression
+
+BLOCK_SIZE = 1024*1024*4
+
+MODE_FASTA = 'fasta'
+MODE_FASTQ = 'fastq'
+MODE_QUAL = 'qual'
+
+class fastxReader:
+
+    def __init__(self, path, mode = MODE_FASTQ, raw = False, shortName = False, blockSize = BLOCK_SIZE, byteRange = None):
+        if mode not in (MODE_FASTA, MODE_FASTQ, MODE_QUAL):
+            raise ValueError('Unknown fastx mode: ' + str(mode))
+
+        self.path = path
+        self.mode = mode
+        self.raw = raw
+        self.shortName = shortName
+        self.blockSize = blockSize
+        self.byteRange = byteRange
+        self.handle = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def open(self):
+        if self.handle is None and hasattr(self.path, 'readinto'):
+            self.handle = self.path
+        if self.handle is None:
+            self.handle = compression.openInput(self.path)
+            if self.byteRange is not None:
+                if compression.detectCompression(self.path) != compression.CODEC_NONE:
+                    raise ValueError('Byte ranges can only be read from uncompressed files: ' + str(self.path))
+                self.handle.seek(self.byteRange[0])
+        return self.handle
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+    def __iter__(self):
+        self.open()
+        if self.mode == MODE_FASTQ:
+            records = parseFastq(self.lines(), self.shortName)
+        elif self.mode == MODE_FASTA:
+            records = parseFasta(self.lines())
+        else:
+            records = parseQual(self.lines())
+
+        if self.raw:
+            return records
+        return (tuple(_decode(field) for field in record) for record in records)
+
+    """ Yields every line (without line ending) as bytes, reading blockSize bytes at a time into a reused buffer """
+    def lines(self):
+        buf = bytearray(self.blockSize)
+        view = memoryview(buf)
+        tail = b''
+        limit = None if self.byteRange is None else self.byteRange[1] - self.byteRange[0]
+
+        while True:
+            size = self.blockSize if limit is None else min(self.blockSize, limit)
+            n = self.handle.readinto(view[:size]) if size > 0 else 0
+            if not n:
+                break
+            if limit is not None:
+                limit -= n
+
+            lastNewline = buf.rfind(b'\n', 0, n)
+            if lastNewline == -1:
+                tail += view[:n]
+                continue
+
+            block = tail + view[:lastNewline] if tail else bytes(view[:lastNewline])
+            tail = bytes(view[lastNewline + 1:n])
+
+            if b'\r' in block:
+                block = block.replace(b'\r', b'')
+
+            yield from block.split(b'\n')
+
+        if tail:
+            yield tail.rstrip(b'\r')
+
+def _decode(field):
+    if isinstance(field, list):
+        return [x.decode('latin-1') for x in field]
+    return field.decode('latin-1')
+
+""" FASTQ records as (name, seq, qual), multi-line records are supported.
+    With shortName the name is cut at the first whitespace (as vsearch/readfq do) """
+def parseFastq(lines, shortName = False):
+    lines = iter(lines)
+    for line in lines:
+        if line[:1] != b'@':
+            continue
+
+        name = (line[1:].split(None, 1) or [b''])[0] if shortName else line[1:].strip()
+        seqParts = []
+        for line in lines:
+            if line[:1] == b'+':
+                break
+            seqParts.append(line)
+        else:
+            raise ValueError('Truncated FASTQ record: ' + name.decode('latin-1'))
+
+        seq = seqParts[0] if len(seqParts) == 1 else b''.join(seqParts)
+        seqLen = len(seq)
+
+        qual = b''
+        for line in lines:
+            qual = qual + line if qual else line
+            if len(qual) >= seqLen:
+                break
+
+        if len(qual) != seqLen:
+            raise ValueError('Sequence and quality length differ for FASTQ record: ' + name.decode('latin-1'))
+
+        yield name, seq, qual
+
+""" FASTA records as (header, seq) """
+def parseFasta(lines):
+    for name, parts in _groupRecords(lines):
+        yield name, b''.join(line.strip() for line in parts)
+
+""" Phrap .qual records as (header, [qualities]), qualities are the whitespace separated tokens """
+def parseQual(lines):
+    for name, quals in _groupRecords(lines):
+        yield name, b' '.join(quals).split()
+
+def _groupRecords(lines):
+    name = None
+    parts = []
+    for line in lines:
+        if line[:1] == b'>':
+            if name is not None:
+                yield name, parts
+            name = line[1:].strip()
+            parts = []
+        elif name is not None:
+            parts.append(line)
+
+    if name is not None:
+        yield name, parts
+
+""" Splits an uncompressed (4 line per record) FASTQ file into at most nChunks (start, end)
+    byte ranges that each begin on a record header """
+def fastqByteRanges(path, nChunks):
+    size = os.path.getsize(path)
+    bounds = [0]
+
+    with open(path, 'rb') as handle:
+        for i in range(1, nChunks):
+            offset = _nextFastqRecord(handle, size * i // nChunks)
+            if bounds[-1] < offset < size:
+                bounds.append(offset)
+
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+""" Offset of the first record header at or after target, a quality line can start with @ as well
+    so a header is only accepted when the line two further down starts with + """
+def _nextFastqRecord(handle, target):
+    handle.seek(max(target - 1, 0))
+    if target > 0:
+        handle.readline()
+
+    while True:
+        position = handle.tell()
+        line = handle.readline()
+        if not line:
+            return position
+        if line[:1] == b'@':
+            handle.readline()
+            if handle.readline()[:1] == b'+':
+                return position
+        handle.seek(position + len(line))
+
+def fastqIter(path, raw = False, shortName = False):
+    with fastxReader(path, MODE_FASTQ, raw, shortName) as reader:
+        yield from reader
+
+""" Writes (name, seq, qual) str records to a text handle """
+def writeFastq(handle, records):
+    for name, seq, qual in records:
+        handle.write('@' + name + '\n' + seq + '\n+\n' + qual + '\n')
+
+def fastaIter(path, raw = False):
+    with fastxReader(path, MODE_FASTA, raw) as reader:
+        yield from reader
+
+def qualIter(path, raw = False):
+    with fastxReader(path, MODE_QUAL, raw) as reader:
+        yield from reader
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import struct
+import numpy as np
+
+""" fastxindex.py: Random access index (.fai-style) for FASTA/FASTQ files
+
+    One streaming pass over the file records, for every sequence, its name, the
+    byte offset and byte span of the sequence lines, the number of bases, the
+    line width and (FASTQ only) the offset and span of the quality lines. The index is
+    stored in a compact binary sidecar (<file>.cfi) and reused as long as the
+    size and modification time of the source file are unchanged. Sequences are
+    only read from disk (with pread) when they are fetched.
+"""
+
+INDEX_SUFFIX = '.cfi'
+INDEX_MAGIC = b'CFXI'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sHBQqQ')
+
+FORMAT_FASTA = 0
+FORMAT_FASTQ = 1
+
+RECORD_DTYPE = np.dtype([
+    ('offset', '<u8'),
+    ('span', '<u8'),
+    ('length', '<u8'),
+    ('lineBases', '<u4'),
+    ('lineBytes', '<u4'),
+    ('qualOffset', '<u8'),
+    ('qualSpan', '<u8'),
+])
+
+WHITESPACE = b' \t\r\n'
+
+class fastxIndex:
+
+    def __init__(self, path, records, names, fileFormat):
+        self.path = path
+        self.records = records
+        self.names = names
+        self.fileFormat = fileFormat
+        self.handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def __len__(self):
+        return len(self.records)
+
+    def close(self):
+        if self.handle is not None:
+            os.close(self.handle)
+            self.handle = None
+
+    @property
+    def lengths(self):
+        return self.records['length']
+
+    """ Record ids ordered from longest to shortest, ties keep file order """
+    def byLength(self, reverse = True):
+        if reverse:
+            return np.argsort(-self.lengths.astype(np.int64), kind='stable')
+        return np.argsort(self.lengths, kind='stable')
+
+    def _read(self, offset, span):
+        if self.handle is None:
+            self.handle = os.open(self.path, os.O_RDONLY)
+        return os.pread(self.handle, span, offset).translate(None, WHITESPACE)
+
+    """ Returns (name, seq) for FASTA or (name, seq, qual) for FASTQ records """
+    def fetch(self, recordId):
+        record = self.records[recordId]
+        seq = self._read(int(record['offset']), int(record['span'])).decode('latin-1')
+        if self.fileFormat == FORMAT_FASTQ:
+            qual = self._read(int(record['qualOffset']), int(record['qualSpan'])).decode('latin-1')
+            return self.names[recordId], seq, qual
+        return self.names[recordId], seq
+
+    def writeFasta(self, recordId, outputHandle):
+        record = self.fetch(recordId)
+        outputHandle.write('>' + record[0] + '\n')
+        outputHandle.write(record[1] + '\n')
+
+def indexPath(path):
+    return path + INDEX_SUFFIX
+
+""" Single streaming pass over path, returns the record array, the names and the file format """
+def scanFastx(path):
+    records = []
+    names = []
+    fileFormat = None
+
+    with open(path, 'rb') as handle:
+        position = 0
+        lines = iter(handle)
+        pending = None
+
+        while True:
+            line = pending if pending is not None else next(lines, None)
+            pending = None
+            if line is None:
+                break
+
+            position += len(line)
+
+            marker = line[:1]
+            if marker not in (b'>', b'@'):
+                continue
+
+            if fileFormat is None:
+                fileFormat = FORMAT_FASTA if marker == b'>' else FORMAT_FASTQ
+
+            names.append(line[1:].strip().decode('latin-1'))
+            offset = position
+            length = 0
+            lineBases = 0
+            lineBytes = 0
+            seqEnd = position
+
+            #sequence lines
+            for line in lines:
+                if line[:1] == b'>' or (fileFormat == FORMAT_FASTQ and line[:1] == b'+'):
+                    pending = line
+                    break
+                position += len(line)
+                bases = len(line.rstrip(WHITESPACE))
+                if bases > 0 and lineBases == 0:
+                    lineBases = bases
+                    lineBytes = len(line)
+                length += bases
+                seqEnd = position
+
+            qualOffset = 0
+            qualSpan = 0
+            if fileFormat == FORMAT_FASTQ:
+                if pending is None or pending[:1] != b'+':
+                    raise ValueError('Truncated FASTQ record: ' + names[-1])
+                position += len(pending)
+                pending = None
+                qualOffset = position
+                qualLength = 0
+                while qualLength < length:
+                    line = next(lines, None)
+                    if line is None:
+                        raise ValueError('Truncated FASTQ record: ' + names[-1])
+                    position += len(line)
+                    qualLength += len(line.rstrip(WHITESPACE))
+                qualSpan = position - qualOffset
+
+            records.append((offset, seqEnd - offset, length, lineBases, lineBytes, qualOffset, qualSpan))
+
+    return np.array(records, dtype=RECORD_DTYPE), names, (FORMAT_FASTA if fileFormat is None else fileFormat)
+
+""" Builds the index for path and writes the sidecar atomically """
+def buildIndex(path):
+    stat = os.stat(path)
+    records, names, fileFormat = scanFastx(path)
+
+    sidecar = indexPath(path)
+    tmpSidecar = sidecar + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpSidecar, 'wb') as handle:
+        handle.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, fileFormat, stat.st_size, stat.st_mtime_ns, len(records)))
+        handle.write(records.tobytes())
+        handle.write('\n'.join(names).encode('latin-1'))
+    os.replace(tmpSidecar, sidecar)
+
+    return fastxIndex(path, records, names, fileFormat)
+
+""" Loads the sidecar of path, returns None when it is missing or stale """
+def loadIndex(path):
+    sidecar = indexPath(path)
+    if os.path.isfile(sidecar) is False:
+        return None
+
+    stat = os.stat(path)
+    with open(sidecar, 'rb') as handle:
+        data = handle.read()
+
+    if len(data) < INDEX_HEADER.size:
+        return None
+
+    magic, version, fileFormat, sourceSize, sourceMtime, nRecords = INDEX_HEADER.unpack_from(data)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+        return None
+    if sourceSize != stat.st_size or sourceMtime != stat.st_mtime_ns:
+        return None
+
+    recordsEnd = INDEX_HEADER.size + nRecords * RECORD_DTYPE.itemsize
+    records = np.frombuffer(data, dtype=RECORD_DTYPE, count=nRecords, offset=INDEX_HEADER.size)
+    names = data[recordsEnd:].decode('latin-1').split('\n') if nRecords > 0 else []
+
+    return fastxIndex(path, records, names, fileFormat)
+
+""" Returns the index of path, building it if it does not exist yet or is stale """
+def indexFor(path):
+    index = loadIndex(path)
+    if index is None:
+        index = buildIndex(path)
+    return index
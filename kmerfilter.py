@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+import fastx
+
+""" kmerfilter.py: In-memory k-mer presence index used to prefilter reads before BLAST
+
+    Every k-mer of the indexed sequences (both strands) is 2-bit encoded and
+    marked in a direct-address table of 4^k flags. A read can only produce a
+    blastn hit when it shares at least one word (word_size, 11 for -task blastn)
+    with the database, so with k equal to the word size reads without any
+    shared k-mer can safely skip BLAST.
+"""
+
+#the index is only lossless up to the blastn word size (11 for -task blastn)
+DEFAULT_K = 11
+MAX_K = 11
+BATCH_SIZE = 10000
+
+INVALID = 4
+SEPARATOR = b'N'
+
+def _buildEncoder():
+    encoder = np.full(256, INVALID, dtype=np.uint8)
+    for code, bases in enumerate(('Aa', 'Cc', 'Gg', 'Tt')):
+        for base in bases:
+            encoder[ord(base)] = code
+    return encoder
+
+ENCODER = _buildEncoder()
+
+""" Encodes a batch into one code array, records are separated by an invalid code so no window spans two records """
+def encodeBatch(seqs):
+    encoded = [seq.encode('latin-1') if isinstance(seq, str) else seq for seq in seqs]
+    lengths = np.fromiter((len(seq) + 1 for seq in encoded), dtype=np.int64, count=len(encoded))
+    starts = np.cumsum(lengths) - lengths
+    return ENCODER[np.frombuffer(SEPARATOR.join(encoded), dtype=np.uint8)], starts
+
+""" 2-bit k-mer value of every window and a mask of windows without invalid bases, k above 16 needs a uint64 dtype """
+def kmerValues(codes, k, dtype = np.uint32):
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=dtype), np.zeros(0, dtype=bool)
+
+    values = np.zeros(n, dtype=dtype)
+    for j in range(k):
+        values <<= 2
+        values |= codes[j:j + n] & 3
+
+    invalid = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(codes == INVALID, out=invalid[1:])
+    valid = (invalid[k:] - invalid[:-k]) == 0
+    return values, valid
+
+""" Reverse complement of a whole code array, invalid codes stay invalid """
+def reverseComplementCodes(codes):
+    return np.where(codes == INVALID, INVALID, 3 - codes).astype(np.uint8)[::-1]
+
+""" Canonical (smaller of both strands) 2-bit value of every valid k-mer of a batch, k up to 32, in read order,
+    plus the index of the first k-mer of every read, a read ends where the next one starts """
+def canonicalKmers(seqs, k):
+    codes, starts = encodeBatch(seqs)
+    forward, valid = kmerValues(codes, k, np.uint64)
+    reverse, _ = kmerValues(reverseComplementCodes(codes), k, np.uint64)
+
+    #the window at p on the forward strand is the window at len - k - p on the reverse complement
+    positions = np.flatnonzero(valid)
+    canonical = np.minimum(forward[positions], reverse[::-1][positions])
+    return canonical, np.searchsorted(positions, starts)
+
+class kmerIndex:
+
+    def __init__(self, k = DEFAULT_K):
+        if k < 1 or k > MAX_K:
+            raise ValueError('k-mer size must be between 1 and ' + str(MAX_K))
+        self.k = k
+        self.table = np.zeros(4 ** k, dtype=bool)
+
+    """ Marks every k-mer of seqs and of their reverse complements """
+    def addSequences(self, seqs):
+        codes, starts = encodeBatch(seqs)
+
+        for strand in (codes, reverseComplementCodes(codes)):
+            values, valid = kmerValues(strand, self.k)
+            self.table[values[valid]] = True
+
+    """ Per sequence flag, True when it shares at least one k-mer with the index """
+    def hasHits(self, seqs):
+        result = np.zeros(len(seqs), dtype=bool)
+        if len(seqs) == 0:
+            return result
+
+        codes, starts = encodeBatch(seqs)
+        values, valid = kmerValues(codes, self.k)
+        positions = np.flatnonzero(valid & self.table[values])
+        result[np.searchsorted(starts, positions, side='right') - 1] = True
+        return result
+
+    def __len__(self):
+        return int(np.count_nonzero(self.table))
+
+""" Builds an index over all sequences in a FASTA file """
+def indexFromFasta(fastaPath, k = DEFAULT_K):
+    index = kmerIndex(k)
+    batch = []
+    for name, seq in fastx.fastaIter(fastaPath, raw=True):
+        batch.append(seq)
+        if len(batch) == BATCH_SIZE:
+            index.addSequences(batch)
+            batch = []
+
+    if batch:
+        index.addSequences(batch)
+
+    return index
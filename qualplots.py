@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+import qualstats
+
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None
+
+""" qualplots.py: Renders the barbershop quality report from a qualstats .npz summary
+
+    Only the summary is read, so rendering costs the same for any number of
+    reads and can be repeated without rerunning QC.
+"""
+
+""" Quantile q of every row of a histogram, rows without counts give nan """
+def histogramQuantiles(histogram, q):
+    totals = histogram.sum(axis=1)
+    cumulative = np.cumsum(histogram, axis=1)
+    targets = np.ceil(totals * q)
+    quantiles = (cumulative < targets[:, None]).sum(axis=1).astype(np.float64)
+    quantiles[totals == 0] = np.nan
+    return quantiles
+
+""" Renders the quality report of one summary to a png, returns False when matplotlib is not available """
+def renderSummary(summaryPath, pngPath, title = ''):
+    if plt is None:
+        return False
+
+    histograms = qualstats.loadHistograms(summaryPath)
+    qualities = np.arange(histograms.positionQuality.shape[1])
+
+    #only positions covered by at least one read
+    covered = np.flatnonzero(histograms.positionQuality.sum(axis=1))
+    positions = np.arange(covered[-1] + 1 if len(covered) else 0)
+    positionQuality = histograms.positionQuality[:len(positions)]
+    perPosition = positionQuality.sum(axis=1)
+    means = np.divide(positionQuality @ qualities, perPosition, out=np.full(len(positions), np.nan), where=perPosition > 0)
+
+    figure, axes = plt.subplots(2, 2, figsize=(14, 10))
+    figure.suptitle(title + ' (' + str(len(histograms)) + ' reads)')
+
+    axis = axes[0][0]
+    axis.fill_between(positions + 1, histogramQuantiles(positionQuality, 0.1), histogramQuantiles(positionQuality, 0.9), alpha=0.2, label='10-90%')
+    axis.fill_between(positions + 1, histogramQuantiles(positionQuality, 0.25), histogramQuantiles(positionQuality, 0.75), alpha=0.4, label='25-75%')
+    axis.plot(positions + 1, histogramQuantiles(positionQuality, 0.5), label='median')
+    axis.plot(positions + 1, means, label='mean')
+    axis.set_xlabel('Position')
+    axis.set_ylabel('Phred quality')
+    axis.legend()
+
+    axis = axes[0][1]
+    axis.bar(qualities, histograms.averageQuality, width=1)
+    axis.set_xlabel('Average read quality')
+    axis.set_ylabel('Reads')
+
+    axis = axes[1][0]
+    lengths = np.flatnonzero(histograms.lengths)
+    end = lengths[-1] + 1 if len(lengths) else 1
+    axis.bar(np.arange(end), histograms.lengths[:end], width=1)
+    axis.set_xlabel('Read length')
+    axis.set_ylabel('Reads')
+
+    axis = axes[1][1]
+    dips = np.flatnonzero(histograms.dips)
+    end = dips[-1] + 1 if len(dips) else 1
+    axis.bar(np.arange(end), histograms.dips[:end], width=1)
+    axis.set_xlabel('Bases below dip threshold')
+    axis.set_ylabel('Reads')
+
+    figure.tight_layout()
+    figure.savefig(pngPath)
+    plt.close(figure)
+    return True
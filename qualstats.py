@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+
+""" qualstats.py: Vectorized per-read quality statistics
+
+    A batch of (ragged) quality strings is decoded into one flat uint8 array
+    plus an offsets array, per-read values are then computed with segment
+    reductions over the whole batch at once. qualityHistograms accumulates
+    batches into fixed size histograms for the QC report.
+"""
+
+PHRED_OFFSET = 33
+
+class qualityBatch:
+
+    def __init__(self, quals, phredOffset = PHRED_OFFSET):
+        encoded = [qual.encode('latin-1') if isinstance(qual, str) else qual for qual in quals]
+        self.lengths = np.fromiter((len(qual) for qual in encoded), dtype=np.int64, count=len(encoded))
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=self.offsets[1:])
+        self.codes = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        self.phredOffset = phredOffset
+
+    def __len__(self):
+        return len(self.lengths)
+
+    """ Per read sum of values, reads of length 0 sum to 0 """
+    def _segmentSum(self, values):
+        sums = np.zeros(len(self.lengths), dtype=np.int64)
+        nonEmpty = self.lengths > 0
+        if nonEmpty.any():
+            sums[nonEmpty] = np.add.reduceat(values, self.offsets[:-1][nonEmpty])
+        return sums
+
+    """ Per read average phred quality, 0 for empty reads """
+    def averageQuality(self):
+        sums = self._segmentSum(self.codes.astype(np.int64)) - self.phredOffset * self.lengths
+        return np.divide(sums, self.lengths, out=np.zeros(len(self.lengths), dtype=np.float64), where=self.lengths > 0)
+
+    """ Per read number of bases with a phred quality below threshold """
+    def dipCounts(self, threshold):
+        return self._segmentSum((self.codes < threshold + self.phredOffset).astype(np.int64))
+
+    """ Per read mask of reads at least minLength long """
+    def lengthMask(self, minLength):
+        return self.lengths >= minLength
+
+""" Average quality, dip count and length of every read in one call """
+def qualityStats(quals, dipThreshold, phredOffset = PHRED_OFFSET):
+    batch = qualityBatch(quals, phredOffset)
+    return batch.averageQuality(), batch.dipCounts(dipThreshold), batch.lengths
+
+MAX_QUALITY = 93
+MAX_LENGTH = 2000
+
+""" Fixed size histograms of a read set, filled batch by batch and mergeable across workers
+
+    positionQuality  reads with a given phred quality (column) at a given position (row)
+    averageQuality   reads per whole average quality
+    lengths          reads per length
+    dips             reads per number of bases below the dip threshold
+    Positions, lengths and dips beyond MAX_LENGTH count towards the last bin.
+"""
+class qualityHistograms:
+
+    def __init__(self):
+        self.positionQuality = np.zeros((MAX_LENGTH + 1, MAX_QUALITY + 1), dtype=np.int64)
+        self.averageQuality = np.zeros(MAX_QUALITY + 1, dtype=np.int64)
+        self.lengths = np.zeros(MAX_LENGTH + 1, dtype=np.int64)
+        self.dips = np.zeros(MAX_LENGTH + 1, dtype=np.int64)
+
+    """ Adds a qualityBatch, averages and dips are its averageQuality() and dipCounts() when already computed """
+    def update(self, batch, averages, dips):
+        positions = np.arange(len(batch.codes), dtype=np.int64) - np.repeat(batch.offsets[:-1], batch.lengths)
+        np.minimum(positions, MAX_LENGTH, out=positions)
+        qualities = np.clip(batch.codes.astype(np.int64) - batch.phredOffset, 0, MAX_QUALITY)
+        cells = self.positionQuality.size
+        self.positionQuality += np.bincount(positions * (MAX_QUALITY + 1) + qualities, minlength=cells).reshape(self.positionQuality.shape)
+
+        self.averageQuality += np.bincount(np.clip(averages.astype(np.int64), 0, MAX_QUALITY), minlength=MAX_QUALITY + 1)
+        self.lengths += np.bincount(np.minimum(batch.lengths, MAX_LENGTH), minlength=MAX_LENGTH + 1)
+        self.dips += np.bincount(np.minimum(dips, MAX_LENGTH), minlength=MAX_LENGTH + 1)
+
+    def merge(self, other):
+        self.positionQuality += other.positionQuality
+        self.averageQuality += other.averageQuality
+        self.lengths += other.lengths
+        self.dips += other.dips
+        return self
+
+    def __len__(self):
+        return int(self.lengths.sum())
+
+    #workers send their histograms back pickled, rows past the longest read are all zero and left out
+    def __getstate__(self):
+        rows = int(np.flatnonzero(self.lengths)[-1]) + 1 if self.lengths.any() else 0
+        return self.positionQuality[:rows], self.averageQuality, self.lengths, self.dips
+
+    def __setstate__(self, state):
+        positionQuality, self.averageQuality, self.lengths, self.dips = state
+        self.positionQuality = np.zeros((MAX_LENGTH + 1, MAX_QUALITY + 1), dtype=np.int64)
+        self.positionQuality[:len(positionQuality)] = positionQuality
+
+    def save(self, path):
+        with open(path, 'wb') as handle:
+            np.savez_compressed(handle, positionQuality=self.positionQuality, averageQuality=self.averageQuality,
+                lengths=self.lengths, dips=self.dips)
+
+def loadHistograms(path):
+    histograms = qualityHistograms()
+    with np.load(path) as summary:
+        histograms.positionQuality = summary['positionQuality']
+        histograms.averageQuality = summary['averageQuality']
+        histograms.lengths = summary['lengths']
+        histograms.dips = summary['dips']
+    return histograms
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+import kmerfilter
+
+""" readbins.py: MinHash binning of reads that are likely to overlap
+
+    Every read gets a MinHash sketch over its canonical k-mers: the smallest
+    value of a number of independent hashes. Sketch rows are cut in bands and
+    reads sharing all values of any band are linked (locality sensitive
+    hashing), so the chance two reads are linked rises steeply with the share
+    of k-mers they have in common. Linked reads form connected components,
+    components too large for one pool are cut in pieces and the pieces are
+    what gets packed into pools, so overlapping reads meet in the same phrap
+    run early on.
+"""
+
+DEFAULT_K = 16
+MAX_K = 32
+DEFAULT_HASHES = 24
+DEFAULT_BAND_ROWS = 2
+BATCH_SIZE = 10000
+
+#sketch value of reads without a single k-mer, they are never linked
+EMPTY = np.iinfo(np.uint64).max
+
+def hashParameters(hashes, seed = 0x5EED):
+    generator = np.random.default_rng(seed)
+    multipliers = generator.integers(1, 2 ** 63, size=hashes, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    offsets = generator.integers(0, 2 ** 63, size=hashes, dtype=np.uint64)
+    return multipliers, offsets
+
+""" MinHash sketch of every sequence of a batch, one row per sequence """
+def sketchBatch(seqs, k, multipliers, offsets):
+    sketches = np.full((len(seqs), len(multipliers)), EMPTY, dtype=np.uint64)
+    if len(seqs) == 0:
+        return sketches
+
+    canonical, bounds = kmerfilter.canonicalKmers(seqs, k)
+    ends = np.append(bounds[1:], len(canonical))
+    hasKmers = ends > bounds
+    if not hasKmers.any():
+        return sketches
+
+    shift = np.uint64(29)
+    for j in range(len(multipliers)):
+        hashed = canonical * multipliers[j] + offsets[j]
+        hashed ^= hashed >> shift
+        sketches[hasKmers, j] = np.minimum.reduceat(hashed, bounds[hasKmers])
+    return sketches
+
+def sketchReads(seqs, k = DEFAULT_K, hashes = DEFAULT_HASHES):
+    if k < 1 or k > MAX_K:
+        raise ValueError('k-mer size must be between 1 and ' + str(MAX_K))
+
+    multipliers, offsets = hashParameters(hashes)
+    return np.concatenate([sketchBatch(seqs[i:i + BATCH_SIZE], k, multipliers, offsets)
+        for i in range(0, len(seqs), BATCH_SIZE)] or [np.zeros((0, hashes), dtype=np.uint64)])
+
+""" Pairs of reads that share all values of at least one band, every read of a bucket is linked to its first read """
+def bandLinks(sketches, bandRows = DEFAULT_BAND_ROWS):
+    first = []
+    other = []
+    candidates = np.flatnonzero(sketches[:, 0] != EMPTY)
+
+    for band in range(0, sketches.shape[1] - bandRows + 1, bandRows):
+        keys = np.ascontiguousarray(sketches[candidates, band:band + bandRows]).view(np.dtype((np.void, 8 * bandRows))).ravel()
+        order = np.argsort(keys, kind='stable')
+        sortedKeys = keys[order]
+        newBucket = np.ones(len(order), dtype=bool)
+        newBucket[1:] = sortedKeys[1:] != sortedKeys[:-1]
+        bucketStart = np.maximum.accumulate(np.where(newBucket, np.arange(len(order)), 0))
+
+        linked = ~newBucket
+        first.append(candidates[order[bucketStart[linked]]])
+        other.append(candidates[order[linked]])
+
+    if not first:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(first), np.concatenate(other)
+
+""" Component label of every node given the links (hook and compress until nothing changes) """
+def connectedComponents(n, a, b):
+    labels = np.arange(n)
+    while True:
+        previous = labels.copy()
+        np.minimum.at(labels, a, labels[b])
+        np.minimum.at(labels, b, labels[a])
+        np.minimum.at(labels, labels[a], labels[b])
+        np.minimum.at(labels, labels[b], labels[a])
+
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+        if np.array_equal(labels, previous):
+            return np.unique(labels, return_inverse=True)[1]
+
+""" Bin of every read, reads (lengths in descending order) of one component share a bin unless the component
+    holds more than maxBases, then it is cut in consecutive pieces of about maxBases """
+def binReads(seqs, maxBases, k = DEFAULT_K, hashes = DEFAULT_HASHES, bandRows = DEFAULT_BAND_ROWS):
+    if hashes < bandRows or bandRows < 1:
+        raise ValueError('binning needs at least one band of ' + str(bandRows) + ' hashes')
+
+    a, b = bandLinks(sketchReads(seqs, k, hashes), bandRows)
+    components = connectedComponents(len(seqs), a, b)
+
+    bins = np.empty(len(seqs), dtype=np.int64)
+    pieceOf = {}
+    basesIn = {}
+    nextBin = 0
+    for i, component in enumerate(components.tolist()):
+        if component not in pieceOf or basesIn[component] >= maxBases:
+            pieceOf[component] = nextBin
+            basesIn[component] = 0
+            nextBin += 1
+        bins[i] = pieceOf[component]
+        basesIn[component] += len(seqs[i])
+
+    return bins
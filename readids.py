@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import array
+import numpy as np
+
+""" readids.py: Dense integer IDs for the reads and contigs of a spike assembly
+
+    Every read gets the next integer when it enters the pool and contigs get
+    the integers after all reads. On disk (and for phrap) an ID is written as
+    a short base-36 name. The reads (or earlier contigs) a contig was
+    assembled from are kept as one flat member array with per contig offsets.
+
+    The reads themselves live in a readStore on disk: packed name and sequence
+    blobs with the end offset of every read and a read group index per read.
+    It is written once while reads are pooled and memory mapped afterwards, so
+    the Python heap does not grow with the number of reads.
+"""
+
+FLUSH_SIZE = 65536
+
+#files of a read store and the dtype they are mapped with
+MAPPED = {'.names': np.uint8, '.seqs': np.uint8, '.nameends': '<i8', '.seqends': '<i8', '.origins': '<u2'}
+
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+def encodeId(value):
+    if value < 36:
+        return DIGITS[value]
+
+    digits = []
+    while value:
+        value, digit = divmod(value, 36)
+        digits.append(DIGITS[digit])
+    return ''.join(reversed(digits))
+
+def decodeId(name):
+    return int(name, 36)
+
+def mapFile(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+class readStore:
+
+    """ basePath is the path without suffix, the store is created on the first read, use open for an existing store """
+    def __init__(self, basePath):
+        self.basePath = basePath
+        self.readGroups = []
+        self.readGroupIndex = {}
+        self.count = 0
+        self.handles = None
+
+    def path(self, suffix):
+        return self.basePath + suffix
+
+    def addReadGroup(self, readGroupName):
+        if readGroupName not in self.readGroupIndex:
+            self.readGroupIndex[readGroupName] = len(self.readGroups)
+            self.readGroups.append(readGroupName)
+        return self.readGroupIndex[readGroupName]
+
+    def create(self):
+        self.count = 0
+        self.nameEnd = 0
+        self.seqEnd = 0
+        self.nameEnds = array.array('q')
+        self.seqEnds = array.array('q')
+        self.origins = array.array('H')
+        if os.path.exists(self.path('.groups')):
+            os.unlink(self.path('.groups'))
+        self.handles = {suffix: open(self.path(suffix), 'wb') for suffix in ('.names', '.seqs', '.nameends', '.seqends', '.origins')}
+
+    """ Appends a read and returns its ID """
+    def add(self, name, readGroupIndex, seq):
+        if self.handles is None:
+            self.create()
+
+        name = name.encode('latin-1')
+        seq = seq.encode('latin-1')
+        self.handles['.names'].write(name)
+        self.handles['.seqs'].write(seq)
+        self.nameEnd += len(name)
+        self.seqEnd += len(seq)
+        self.nameEnds.append(self.nameEnd)
+        self.seqEnds.append(self.seqEnd)
+        self.origins.append(readGroupIndex)
+        self.count += 1
+
+        if len(self.origins) >= FLUSH_SIZE:
+            self.flush()
+        return self.count - 1
+
+    def flush(self):
+        for suffix, values in (('.nameends', self.nameEnds), ('.seqends', self.seqEnds), ('.origins', self.origins)):
+            self.handles[suffix].write(np.asarray(values, dtype=MAPPED[suffix]).tobytes())
+            del values[:]
+
+    """ Finishes writing and maps the store for reading """
+    def close(self):
+        if self.handles is None:
+            return
+
+        self.flush()
+        for handle in self.handles.values():
+            handle.close()
+        self.handles = None
+
+        #written last, marks the store as complete
+        with open(self.path('.groups'), 'w') as groupsHandle:
+            for readGroupName in self.readGroups:
+                groupsHandle.write(readGroupName + '\n')
+        self.open()
+
+    def open(self):
+        with open(self.path('.groups')) as groupsHandle:
+            self.readGroups = [line.rstrip('\n') for line in groupsHandle]
+        self.readGroupIndex = {readGroupName: i for i, readGroupName in enumerate(self.readGroups)}
+        self.mapped = {suffix: mapFile(self.path(suffix), dtype) for suffix, dtype in MAPPED.items()}
+        self.count = len(self.mapped['.origins'])
+
+    def _slice(self, blob, ends, readId):
+        return bytes(self.mapped[blob][self.mapped[ends][readId - 1] if readId else 0:self.mapped[ends][readId]])
+
+    def name(self, readId):
+        return self._slice('.names', '.nameends', readId).decode('latin-1')
+
+    def sequence(self, readId):
+        return self._slice('.seqs', '.seqends', readId).decode('latin-1')
+
+    def readGroup(self, readId):
+        return self.readGroups[self.mapped['.origins'][readId]]
+
+    def __len__(self):
+        return self.count
+
+class readRegistry:
+
+    """ Reads are kept in the readStore at storePath, contigs in memory """
+    def __init__(self, storePath):
+        self.store = readStore(storePath)
+        self.members = array.array('q')
+        self.memberOffsets = array.array('q', [0])
+
+    def addReadGroup(self, readGroupName):
+        return self.store.addReadGroup(readGroupName)
+
+    """ Registers a read and returns its ID, all reads have to be added before the first contig """
+    def addRead(self, name, readGroupIndex, seq):
+        if len(self.memberOffsets) > 1:
+            raise Exception('Reads can not be added after contigs')
+        return self.store.add(name, readGroupIndex, seq)
+
+    """ Call once all reads are added """
+    def closeReads(self):
+        self.store.close()
+
+    """ Maps the reads of a store written by an earlier run """
+    def openReads(self):
+        self.store.open()
+
+    """ Writes the contig members atomically, replacing path only once the data is complete """
+    def saveContigs(self, path):
+        partialPath = path + '.partial'
+        with open(partialPath, 'wb') as contigHandle:
+            np.savez(contigHandle, members=np.frombuffer(self.members, dtype=np.int64),
+                memberOffsets=np.frombuffer(self.memberOffsets, dtype=np.int64))
+            contigHandle.flush()
+            os.fsync(contigHandle.fileno())
+        os.replace(partialPath, path)
+
+    def loadContigs(self, path):
+        with np.load(path) as saved:
+            self.members = array.array('q', saved['members'].tobytes())
+            self.memberOffsets = array.array('q', saved['memberOffsets'].tobytes())
+
+    """ Registers a contig made of the given read or contig IDs and returns its ID """
+    def addContig(self, memberIds):
+        self.members.extend(memberIds)
+        self.memberOffsets.append(len(self.members))
+        return self.readCount() + len(self.memberOffsets) - 2
+
+    """ Registers a run of contigs at once, memberCounts holds the number of members per contig
+        in the flat members array, returns the ID of the first contig """
+    def addContigs(self, members, memberCounts):
+        firstId = len(self)
+        self.members.frombytes(np.asarray(members, dtype=np.int64).tobytes())
+        self.memberOffsets.frombytes((np.cumsum(memberCounts, dtype=np.int64) + self.memberOffsets[-1]).tobytes())
+        return firstId
+
+    def readCount(self):
+        return len(self.store)
+
+    def __len__(self):
+        return self.readCount() + len(self.memberOffsets) - 1
+
+    def isRead(self, readId):
+        return readId < self.readCount()
+
+    def name(self, readId):
+        return self.store.name(readId)
+
+    def sequence(self, readId):
+        return self.store.sequence(readId)
+
+    def readGroup(self, readId):
+        return self.store.readGroup(readId)
+
+    def contigMembers(self, contigId):
+        index = contigId - self.readCount()
+        return self.members[self.memberOffsets[index]:self.memberOffsets[index + 1]]
+
+    """ IDs of all reads a read or contig is made of """
+    def reads(self, readId):
+        pending = [readId]
+        while pending:
+            current = pending.pop()
+            if self.isRead(current):
+                yield current
+            else:
+                pending.extend(reversed(self.contigMembers(current)))
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import io
+import os
+import shutil
+import threading
+import argparse
+from collections import Counter
+import numpy as np
+import fastx
+
+""" rejects.py: Sinks for reads rejected by the barbershop
+
+    fastq   writes every rejected read in full, with the reason in the header
+    index   writes one small binary record per rejected read: the ordinal of
+            the read in the input of the rejecting step, a reason code and two
+            metrics. rebuildFastq recreates the fastq sink from the original
+            input on demand
+    counts  only writes the number of rejects per reason
+
+    Every barbershop step keeps its input order and only removes reads, so an
+    ordinal in the input of a later step maps back to the original input once
+    the reads removed by the earlier steps are known. That is why the index
+    also records the duplicates removed by dereplication.
+
+    A sink can be shared by steps running on different threads (the pipelined
+    barbershop feeds external tools from a thread), every call holds its lock.
+"""
+
+SINK_FASTQ = 'fastq'
+SINK_INDEX = 'index'
+SINK_COUNTS = 'counts'
+SINKS = (SINK_FASTQ, SINK_INDEX, SINK_COUNTS)
+SUFFIXES = {SINK_FASTQ: '.fastq', SINK_INDEX: '.idx', SINK_COUNTS: '.counts'}
+
+RECORD_DTYPE = np.dtype([('ordinal', '<u8'), ('reason', 'u1'), ('metric1', '<f4'), ('metric2', '<f4')])
+FLUSH_SIZE = 65536
+
+TRIMMER_COMPRESSION_RATIO = 1
+TRIMMER_TOO_SHORT = 2
+TRIMMER_QUALITY_OR_LENGTH = 3
+UNIVEC_FRAG_TOO_SMALL = 4
+DEREP_DUPLICATE = 5
+DIGINORM_DEPTH = 6
+
+#step of the barbershop a reason belongs to, steps run in this order
+STEPS = {
+    TRIMMER_COMPRESSION_RATIO: 0,
+    TRIMMER_TOO_SHORT: 0,
+    TRIMMER_QUALITY_OR_LENGTH: 0,
+    UNIVEC_FRAG_TOO_SMALL: 1,
+    DEREP_DUPLICATE: 2,
+    DIGINORM_DEPTH: 3,
+}
+
+NAMES = {
+    TRIMMER_COMPRESSION_RATIO: 'TRIMMER-COMPRESSION-RATIO',
+    TRIMMER_TOO_SHORT: 'TRIMMER-TOO-SHORT',
+    TRIMMER_QUALITY_OR_LENGTH: 'TRIMMER-QUALITY-OR-LENGTH',
+    UNIVEC_FRAG_TOO_SMALL: 'UNIVEC-FRAG-TOO-SMALL',
+    DEREP_DUPLICATE: 'DEREP-DUPLICATE',
+    DIGINORM_DEPTH: 'DIGINORM-DEPTH',
+}
+
+""" Header of a rejected read as written by the fastq sink """
+def rejectHeader(reason, name, length, metric1 = None, metric2 = None):
+    if reason == TRIMMER_COMPRESSION_RATIO:
+        return name + 'TRIMMER-COMPRESSION-RATIO (' + str(metric1) +')'
+    if reason == TRIMMER_TOO_SHORT:
+        return name + ' TRIMMER-TOO-SHORT '
+    if reason == TRIMMER_QUALITY_OR_LENGTH:
+        return name + ' TRIMMER-QUALITY-OR-LENGTH LEN: ' + str(length) + ' AVG_QUAL: ' + str(metric1) + ' DIPSUM: ' + str(metric2) + '  '
+    if reason == UNIVEC_FRAG_TOO_SMALL:
+        return name + ' UNIVEC-FRAG-TOO-SMALL '
+    if reason == DIGINORM_DEPTH:
+        return name + ' DIGINORM-DEPTH (' + str(metric1) + ')'
+    return name + ' ' + NAMES[reason]
+
+def sinkMode(args):
+    mode = args.get('barbershop', 'rejectSink', fallback=SINK_FASTQ)
+    if mode not in SINKS:
+        raise ValueError('rejectSink should be one of ' + ', '.join(SINKS) + ', not ' + str(mode))
+    return mode
+
+def sinkPath(basePath, mode):
+    return basePath + SUFFIXES[mode]
+
+class rejectSink:
+
+    """ basePath is the path without suffix, None keeps the rejects in memory (see payload) """
+    def __init__(self, basePath, mode = SINK_FASTQ, append = True):
+        self.basePath = basePath
+        self.mode = mode
+        self.counts = Counter()
+        self.records = []
+        self.handle = None
+        self.lock = threading.RLock()
+
+        if mode == SINK_FASTQ:
+            self.handle = io.StringIO() if basePath is None else open(sinkPath(basePath, mode), 'a' if append else 'w', 8388608, encoding='latin-1')
+        elif mode == SINK_INDEX:
+            self.handle = io.BytesIO() if basePath is None else open(sinkPath(basePath, mode), 'ab' if append else 'wb')
+        elif basePath is not None and not append:
+            open(sinkPath(basePath, mode), 'w').close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    """ Records a rejected read, ordinal is its position in the input of the current step """
+    def reject(self, ordinal, reason, name, seq, qual, metric1 = None, metric2 = None):
+        with self.lock:
+            self.counts[reason] += 1
+            if self.mode == SINK_FASTQ:
+                self.handle.write('@' + rejectHeader(reason, name, len(seq), metric1, metric2) + '\n' + seq + '\n+\n' + qual + '\n')
+            elif self.mode == SINK_INDEX:
+                self._record(ordinal, reason, metric1, metric2)
+
+    """ Records a removed read that is not a reject, only the index needs these to map ordinals """
+    def drop(self, ordinal, reason):
+        with self.lock:
+            self.counts[reason] += 1
+            if self.mode == SINK_INDEX:
+                self._record(ordinal, reason, None, None)
+
+    def _record(self, ordinal, reason, metric1, metric2):
+        self.records.append((ordinal, reason, 0 if metric1 is None else metric1, 0 if metric2 is None else metric2))
+        if len(self.records) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.records:
+                self.handle.write(np.array(self.records, dtype=RECORD_DTYPE).tobytes())
+                self.records = []
+
+    """ In memory sinks: the written rejects and the counts, merged into a file sink with extend """
+    def payload(self):
+        with self.lock:
+            self.flush()
+            return (self.handle.getvalue() if self.handle is not None else None), self.counts
+
+    """ Adds the payload of another sink, its ordinals start at ordinalOffset """
+    def extend(self, payload, ordinalOffset = 0):
+        data, counts = payload
+        with self.lock:
+            self.counts.update(counts)
+            if self.mode == SINK_FASTQ:
+                self.handle.write(data)
+            elif self.mode == SINK_INDEX:
+                self.flush()
+                records = np.frombuffer(data, dtype=RECORD_DTYPE).copy()
+                records['ordinal'] += ordinalOffset
+                self.handle.write(records.tobytes())
+
+    def close(self):
+        if self.mode == SINK_INDEX:
+            self.flush()
+        if self.mode == SINK_COUNTS and self.basePath is not None:
+            with open(sinkPath(self.basePath, self.mode), 'a') as countsHandle:
+                for reason, count in sorted(self.counts.items()):
+                    countsHandle.write(NAMES[reason] + '\t' + str(count) + '\n')
+        if self.handle is not None and self.basePath is not None:
+            self.handle.close()
+
+""" Merges sinks written per part into basePath, ordinalOffsets holds the first ordinal of every part """
+def mergeParts(partBasePaths, basePath, mode, ordinalOffsets, append = True):
+    if mode == SINK_FASTQ:
+        with open(sinkPath(basePath, mode), 'ab' if append else 'wb') as targetHandle:
+            for partBasePath in partBasePaths:
+                with open(sinkPath(partBasePath, mode), 'rb') as partHandle:
+                    shutil.copyfileobj(partHandle, targetHandle, 1024*1024*10)
+                os.unlink(sinkPath(partBasePath, mode))
+        return
+
+    with rejectSink(basePath, mode, append) as sink:
+        for partBasePath, ordinalOffset in zip(partBasePaths, ordinalOffsets):
+            partPath = sinkPath(partBasePath, mode)
+            if mode == SINK_COUNTS:
+                sink.counts.update(_countsFrom(partPath))
+            else:
+                with open(partPath, 'rb') as partHandle:
+                    sink.extend((partHandle.read(), Counter()), ordinalOffset)
+            os.unlink(partPath)
+
+def _countsFrom(countsPath):
+    byName = {name: reason for reason, name in NAMES.items()}
+    counts = Counter()
+    with open(countsPath) as countsHandle:
+        for line in countsHandle:
+            name, count = line.rstrip('\n').split('\t')
+            counts[byName[name]] += int(count)
+    return counts
+
+""" Rejects per reason name from any sink file """
+def readCounts(path):
+    if path.endswith(SUFFIXES[SINK_INDEX]):
+        reasons, counts = np.unique(readIndex(path)['reason'], return_counts=True)
+        return Counter({NAMES[int(reason)]: int(count) for reason, count in zip(reasons, counts)})
+    if path.endswith(SUFFIXES[SINK_COUNTS]):
+        return Counter({NAMES[reason]: count for reason, count in _countsFrom(path).items()})
+
+    counts = Counter()
+    for name, seq, qual in fastx.fastqIter(path):
+        for reason, reasonName in NAMES.items():
+            if reasonName in name:
+                counts[reasonName] += 1
+                break
+    return counts
+
+def readIndex(indexPath):
+    return np.fromfile(indexPath, dtype=RECORD_DTYPE)
+
+""" Maps the step local ordinals of the index to ordinals in the original input """
+def originalOrdinals(records):
+    steps = np.array([STEPS[int(reason)] for reason in records['reason']], dtype=np.int64) if len(records) else np.zeros(0, dtype=np.int64)
+    original = np.zeros(len(records), dtype=np.int64)
+    removed = np.zeros(0, dtype=np.int64)
+
+    for step in sorted(set(STEPS.values())):
+        selection = np.flatnonzero(steps == step)
+        if len(selection) == 0:
+            continue
+
+        #the o-th read surviving all earlier steps is o plus the number of removed reads up to it
+        ordinals = records['ordinal'][selection].astype(np.int64)
+        survivorsBefore = removed - np.arange(len(removed))
+        original[selection] = ordinals + np.searchsorted(survivorsBefore, ordinals, side='right')
+        removed = np.sort(np.concatenate((removed, original[selection])))
+
+    return original
+
+""" Recreates the fastq sink of an index from the original (staged) input of the read group """
+def rebuildFastq(indexPath, inputPath, outputPath):
+    records = readIndex(indexPath)
+    original = originalOrdinals(records)
+
+    keep = records['reason'] != DEREP_DUPLICATE
+    records = records[keep]
+    original = original[keep]
+    order = np.argsort(original, kind='stable')
+    records = records[order]
+    original = original[order]
+
+    written = 0
+    with open(outputPath, 'w', 8388608, encoding='latin-1') as outputHandle:
+        for ordinal, (name, seq, qual) in enumerate(fastx.fastqIter(inputPath, shortName=True)):
+            if written == len(records):
+                break
+            if original[written] != ordinal:
+                continue
+
+            #the original read, later steps may have trimmed it before rejecting
+            record = records[written]
+            reason = int(record['reason'])
+            metric1 = record['metric1']
+            metric2 = record['metric2']
+            if reason in (TRIMMER_QUALITY_OR_LENGTH, DIGINORM_DEPTH):
+                metric2 = int(metric2)
+                if reason == DIGINORM_DEPTH:
+                    metric1 = int(metric1)
+
+            outputHandle.write('@' + rejectHeader(reason, name, len(seq), metric1, metric2) + '\n' + seq + '\n+\n' + qual + '\n')
+            written += 1
+
+    return written
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuilds the rejected reads of a barbershop reject index")
+    parser.add_argument('--index', dest='index', action='store', required=True,
+                    help='Reject index (<readgroup>.rejected.idx)')
+    parser.add_argument('--input', dest='input', action='store', required=True,
+                    help='Original input of the read group (<readgroup>.original.fastq)')
+    parser.add_argument('--out', dest='out', action='store', required=True,
+                    help='Output fastq')
+
+    args = parser.parse_args()
+    print('Rebuilt rejected reads: ' + str(rebuildFastq(args.index, args.input, args.out)))
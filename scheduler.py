@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import time
+import queue
+import tempfile
+import threading
+import logging
+from subprocess import Popen, DEVNULL
+from cactusUtils import availableCores
+
+""" scheduler.py: Runs batches of external tools within a core budget
+
+    Every job states how many cores it uses and jobs are started as long as
+    they fit in the budget (a job larger than the budget runs on its own).
+    A waiter thread per job blocks in wait4 and reports the exit, so a
+    finished job frees its cores (and the batch ends) the moment it exits
+    instead of at the next poll. wait4 also returns the cpu time of the job.
+    stderr goes to a temporary file so a chatty tool can never block on a
+    full pipe, and is kept for failed jobs only.
+"""
+
+#bytes of stderr kept for a failed job
+STDERR_TAIL = 4096
+
+class job:
+
+    def __init__(self, name, command, cores = 1, stdout = DEVNULL):
+        self.name = name
+        self.command = command
+        self.cores = cores
+        self.stdout = stdout
+        self.returncode = None
+        self.stderr = ''
+        self.wallTime = 0.0
+        self.cpuTime = 0.0
+
+    def failed(self):
+        return self.returncode != 0
+
+""" Runs all jobs, at most budget cores (default: all available) busy at once. Returns the jobs with their exit
+    code, wall and cpu time filled in, raises an Exception listing the failed jobs when check is set """
+def runJobs(jobs, budget = None, check = False, logger = None):
+    if logger is None:
+        logger = logging.getLogger('cactus')
+    if budget is None:
+        budget = availableCores()
+
+    pending = list(jobs)
+    pending.reverse()
+    running = {}
+    busy = 0
+    exits = queue.Queue()
+    started = time.monotonic()
+
+    while pending or running:
+        while pending and (busy + pending[-1].cores <= budget or not running):
+            current = pending.pop()
+            running[current] = _start(current, exits)
+            busy += current.cores
+
+        current, status, rusage = exits.get()
+        process, stderrHandle, startTime = running.pop(current)
+        busy -= current.cores
+
+        current.returncode = os.waitstatus_to_exitcode(status)
+        process.returncode = current.returncode
+        current.wallTime = time.monotonic() - startTime
+        current.cpuTime = rusage.ru_utime + rusage.ru_stime
+
+        if current.failed():
+            stderrHandle.seek(max(0, os.fstat(stderrHandle.fileno()).st_size - STDERR_TAIL))
+            current.stderr = stderrHandle.read().decode('utf-8', 'replace')
+            logger.error(current.name + ' exited with ' + str(current.returncode) + ': ' + current.stderr.strip())
+        stderrHandle.close()
+
+        logger.debug(current.name + ' done in ' + '{:.1f}'.format(current.wallTime) + 's wall, ' + '{:.1f}'.format(current.cpuTime) + 's cpu, '
+            + str(len(running) + len(pending)) + ' jobs left')
+
+    logger.debug(str(len(jobs)) + ' jobs done in ' + '{:.1f}'.format(time.monotonic() - started) + 's')
+
+    failed = [current for current in jobs if current.failed()]
+    if check and failed:
+        raise Exception(str(len(failed)) + ' of ' + str(len(jobs)) + ' jobs failed: '
+            + ', '.join(current.name + ' (' + str(current.returncode) + ')' for current in failed))
+    return jobs
+
+def _start(current, exits):
+    stderrHandle = tempfile.TemporaryFile()
+    process = Popen(current.command, stdout=current.stdout, stderr=stderrHandle, close_fds=True)
+    startTime = time.monotonic()
+
+    def wait():
+        pid, status, rusage = os.wait4(process.pid, 0)
+        exits.put((current, status, rusage))
+
+    threading.Thread(target=wait, daemon=True).start()
+    return process, stderrHandle, startTime
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+
+""" seqops.py: Batch sequence transforms used in post-assembly clean-up
+
+    All kernels take a list of sequences (str or bytes) and return a list of the
+    same type. Work is done with bytes.translate over the joined batch and NumPy
+    segment reductions, so there is no per-character Python loop.
+"""
+
+NUCLEOTIDES = b'ACTGactg'
+GAP = ord('-')
+
+COMPLEMENT_FROM = b'ATGCN-'
+COMPLEMENT_TO = b'TACGN-'
+COMPLEMENT_TABLE = bytes.maketrans(COMPLEMENT_FROM, COMPLEMENT_TO)
+
+#separator used when joining a batch, must not be a valid sequence character
+SEPARATOR = b'\n'
+
+MAX_POSTERIOR_GAP_LENGTH = 10
+MAX_POSTERIOR_GAP_ISLAND_LENGTH = 6
+
+LEADING_TRAILING_GAP_CHARS = b'-actg'
+UPPER_TABLE = bytes.maketrans(b'abcdefghijklmnopqrstuvwxyz', b'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
+def _lookup(chars):
+    table = np.zeros(256, dtype=bool)
+    table[np.frombuffer(chars, dtype=np.uint8)] = True
+    return table
+
+IS_NUCLEOTIDE = _lookup(NUCLEOTIDES)
+IS_LEADING_TRAILING_GAP = _lookup(LEADING_TRAILING_GAP_CHARS)
+
+def _encode(seqs):
+    if len(seqs) > 0 and isinstance(seqs[0], str):
+        return [seq.encode('latin-1') for seq in seqs], True
+    return [bytes(seq) for seq in seqs], False
+
+def _decode(seqs, asStr):
+    if asStr:
+        return [seq.decode('latin-1') for seq in seqs]
+    return seqs
+
+""" Flattens a batch into one uint8 array, returns it with the start and length of every record """
+def _flatten(seqs):
+    lengths = np.fromiter((len(seq) for seq in seqs), dtype=np.int64, count=len(seqs))
+    starts = np.cumsum(lengths) - lengths
+    codes = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+    return codes, starts, lengths
+
+""" Per record minimum (or maximum) of values, records of length 0 get the fill value """
+def _segmentReduce(ufunc, values, starts, lengths, fill):
+    result = np.full(len(lengths), fill, dtype=np.int64)
+    nonEmpty = lengths > 0
+    if nonEmpty.any():
+        result[nonEmpty] = ufunc.reduceat(values, starts[nonEmpty])
+    return result
+
+""" Reverse complement of every sequence, raises KeyError on characters outside ATGCN- """
+def revcompBatch(seqs):
+    seqs, asStr = _encode(seqs)
+    if len(seqs) == 0:
+        return []
+
+    joined = SEPARATOR.join(seqs)
+    invalid = joined.translate(None, COMPLEMENT_FROM + SEPARATOR)
+    if invalid:
+        raise KeyError(chr(invalid[0]))
+
+    complemented = joined.translate(COMPLEMENT_TABLE)[::-1].split(SEPARATOR)
+    complemented.reverse()
+    return _decode(complemented, asStr)
+
+""" Clips short nucleotide islands that are followed by a long run of gaps.
+    Scanning starts at the first nucleotide, the record is left as-is once more than
+    MAX_POSTERIOR_GAP_ISLAND_LENGTH non-gap characters are seen, and clipped as soon as
+    more than MAX_POSTERIOR_GAP_LENGTH gaps are seen. """
+def gapClipperBatch(seqs):
+    seqs, asStr = _encode(seqs)
+    if len(seqs) == 0:
+        return []
+
+    codes, starts, lengths = _flatten(seqs)
+    nSeqs = len(seqs)
+    big = np.iinfo(np.int64).max
+    local = np.arange(len(codes), dtype=np.int64) - np.repeat(starts, lengths)
+
+    firstNucl = _segmentReduce(np.minimum, np.where(IS_NUCLEOTIDE[codes], local, big), starts, lengths, big)
+    after = local > np.repeat(firstNucl, lengths)
+    isGap = codes == GAP
+    gapsAfter = isGap & after
+    islandAfter = ~isGap & after
+
+    gapCount = _segmentCumsum(gapsAfter, starts, lengths)
+    islandCount = _segmentCumsum(islandAfter, starts, lengths)
+
+    gapTrigger = _segmentReduce(np.minimum, np.where(gapCount > MAX_POSTERIOR_GAP_LENGTH, local, big), starts, lengths, big)
+    islandTrigger = _segmentReduce(np.minimum, np.where(islandCount > MAX_POSTERIOR_GAP_ISLAND_LENGTH, local, big), starts, lengths, big)
+    clipped = (gapTrigger < islandTrigger)
+
+    beforeTrigger = local < np.repeat(gapTrigger, lengths)
+    boundary = _segmentReduce(np.maximum, np.where(islandAfter & beforeTrigger, local + 1, 0), starts, lengths, 0)
+
+    result = list(seqs)
+    for i in np.flatnonzero(clipped).tolist():
+        result[i] = _clip(seqs[i], int(firstNucl[i]), int(boundary[i]))
+
+    return _decode(result, asStr)
+
+def _segmentCumsum(mask, starts, lengths):
+    total = np.cumsum(mask, dtype=np.int64)
+    before = np.where(starts > 0, total[starts - 1], 0) if len(total) > 0 else starts
+    return total - np.repeat(before, lengths)
+
+""" Applies the clip of a triggered record, boundary 0 means no island was seen after the start """
+def _clip(seq, start, boundary):
+    islandLength = boundary - start
+    if islandLength == 0:
+        islandLength = 1
+
+    if start == 0:
+        return b'-' * islandLength + seq[islandLength:]
+    return seq[:start] + b'-' * islandLength + seq[boundary:]
+
+""" Replaces leading and trailing gaps and lowercase bases by replaceChar and uppercases the result """
+def replaceLeadingAndTrailingGapsBatch(seqs, replaceChar = '~'):
+    seqs, asStr = _encode(seqs)
+    if len(seqs) == 0:
+        return []
+
+    replace = replaceChar.encode('latin-1') if isinstance(replaceChar, str) else bytes(replaceChar)
+    if len(replace) != 1:
+        raise ValueError('replaceChar must be a single character')
+
+    replace = replace.translate(UPPER_TABLE)
+    leadingTable = UPPER_TABLE.replace(b'-', replace)
+
+    codes, starts, lengths = _flatten(seqs)
+    local = np.arange(len(codes), dtype=np.int64) - np.repeat(starts, lengths)
+    keep = ~IS_LEADING_TRAILING_GAP[codes]
+
+    firstKept = _segmentReduce(np.minimum, np.where(keep, local, np.iinfo(np.int64).max), starts, lengths, -1).tolist()
+    lastKept = _segmentReduce(np.maximum, np.where(keep, local, -1), starts, lengths, -1).tolist()
+
+    result = []
+    for seq, first, last in zip(seqs, firstKept, lastKept):
+        if last == -1:
+            result.append(replace * len(seq))
+        else:
+            result.append(seq[:first].translate(leadingTable) + seq[first:last + 1].translate(UPPER_TABLE) + replace * (len(seq) - last - 1))
+
+    return _decode(result, asStr)
+
+def revcomp(dna):
+    return revcompBatch([dna])[0]
+
+def gapClipper(seq):
+    return gapClipperBatch([seq])[0]
+
+def replaceLeadingAndTrailingGaps(seq, replaceChar = '~'):
+    return replaceLeadingAndTrailingGapsBatch([seq], replaceChar)[0]
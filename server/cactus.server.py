@@ -309,11 +309,9 @@ class cactusServer:
 
         print('Splitting ')
         fasta = inputFasta
-        nSeq = self.countFasta(fasta)
 
         nInstances = len(self.config.items('instances'))
         self.threadStore = self.config.get('settings', 'seqsplit')
-        nSeqPerInstance = math.ceil(nSeq / nInstances)
 
         seqLib = defaultdict(dict)
         fiter = self.fastaIter(fasta)
@@ -326,6 +324,10 @@ class cactusServer:
             seqLib[seqId]['seq'] = seq
             seqId += 1
 
+        #count from the loaded library instead of parsing the file twice
+        nSeq = len(seqLib)
+        nSeqPerInstance = math.ceil(nSeq / nInstances)
+
         threadFiles = defaultdict(dict)
         threadFilesTxt = defaultdict(dict)
         for n in range(nInstances):
@@ -4,19 +4,26 @@ import sys
 import aligntest
 from subprocess import call
 import pprint
-import hashlib
 import json
 import csv
 import time
 from cactusUtils import *
+import fastx
+import compression
+import readids
+import scheduler
+import readbins
 from contig import contigObject
 from collections import Counter
 from collections import defaultdict
 from shutil import copyfile
 from subprocess import Popen, PIPE
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import matplotlib.pyplot as plt
 import logging
 import math
+import heapq
 import numpy
 
 """ spike.py: Phrap powered assembler
@@ -25,6 +32,80 @@ import numpy
     at assembling from low-depth datasets
 """
 
+""" Parses the phrap results of one pool, poolPath is the pool fasta the results were written next to.
+    Runs in a worker process and returns compact data for an ordered merge: the decoded member IDs of all
+    contigs with the number of members per contig, the contig sequences and fastq qualities as newline
+    separated blocks in contig order, and the singlets as ready fastq text with their count """
+def ingestPool(poolPath):
+    compositions = parseAce(poolPath + '.ace')
+
+    qualities = {}
+    for name, qual in fastx.qualIter(poolPath + '.contigs.qual', raw=True):
+        qualities[name] = phredToFastq(qual)
+
+    members = []
+    memberCounts = []
+    seqs = []
+    quals = []
+    for name, seq in fastx.fastaIter(poolPath + '.contigs', raw=True):
+        composition = compositions[name.decode('latin-1').split('.')[-1]]
+        members.extend(readids.decodeId(member) for member in composition)
+        memberCounts.append(len(composition))
+        seqs.append(seq)
+        quals.append(qualities[name])
+
+    #singlets keep their id and the qualities they went into the pool with
+    singlets = list(fastx.fastaIter(poolPath + '.singlets', raw=True))
+    wanted = set(name for name, seq in singlets)
+    singletQualities = {}
+    for name, qual in fastx.qualIter(poolPath + '.qual', raw=True):
+        if name in wanted:
+            singletQualities[name] = phredToFastq(qual)
+
+    singletText = []
+    for name, seq in singlets:
+        if name not in singletQualities:
+            raise Exception('Could not find qualities for singlet: "' + name.decode('latin-1') + '"')
+        singletText.append(b'@' + name + b'\n' + seq + b'\n+\n' + singletQualities[name] + b'\n')
+
+    return (numpy.array(members, dtype=numpy.int64), numpy.array(memberCounts, dtype=numpy.int64),
+        b'\n'.join(seqs), b'\n'.join(quals), b''.join(singletText), len(singlets))
+
+""" Phrap quality tokens as a fastq quality string """
+def phredToFastq(tokens):
+    return (numpy.array(tokens, dtype=numpy.int64) + 33).astype(numpy.uint8).tobytes()
+
+""" Checkpoint of the last finished assembly pass in the results folder at outputPath """
+def spikeCheckpointPath(outputPath, args):
+    return outputPath + args.get('directories', 'spikeOutput') + '/checkpoint.json'
+
+PROFILE_STRICT = 'strict'
+PROFILE_LOOSE = 'loose'
+PROFILES = (PROFILE_STRICT, PROFILE_LOOSE)
+
+""" Predicted phrap runtime in seconds of a pool, model holds the cost per read, per base and per squared base """
+def poolCost(reads, bases, model):
+    return model[0] * reads + model[1] * bases + model[2] * bases * bases
+
+""" Assigns units of (reads, bases) to poolN pools, largest unit first every unit goes to the pool with the lowest
+    predicted cost so far (LPT). Returns the pool of every unit and per pool [reads, bases, predicted cost] """
+def balancePools(units, poolN, model):
+    pools = [[0, 0, 0.0] for i in range(poolN)]
+    heap = [(0.0, i) for i in range(poolN)]
+    assignment = [0] * len(units)
+
+    for unit in sorted(range(len(units)), key=lambda x: poolCost(units[x][0], units[x][1], model), reverse=True):
+        reads, bases = units[unit]
+        cost, i = heapq.heappop(heap)
+        pool = pools[i]
+        pool[0] += reads
+        pool[1] += bases
+        pool[2] = poolCost(pool[0], pool[1], model)
+        heapq.heappush(heap, (pool[2], i))
+        assignment[unit] = i
+
+    return assignment, pools
+
 class spikeObject:
 
     def __init__(self, readGroups, outputPath, args):
@@ -37,14 +118,16 @@ class spikeObject:
         self.spikeContigs = outputPath + self.args.get('directories', 'spikeOutput') + str('/contigs')
         self.spikeGraphs = outputPath + self.args.get('directories', 'spikeOutput') + str('/graphs')
         self.barbershopOutput = outputPath + self.args.get('directories', 'barbershopOutput')
-        self.seqConnector = defaultdict(dict)
+        self.readRegistry = readids.readRegistry(self.spikeOutput + '/reads')
         self.poolInMemory = defaultdict(dict)
         self.seqCounter = 0
         self.currentPass = 0
         self.poolHandles = defaultdict(dict)
         self.poolContent = defaultdict(dict)
+        self.poolPredictions = []
 
-        self.contigRegister = defaultdict(dict)
+        self.poolCodec = self.args.get('spike', 'intermediateCompression', fallback=compression.CODEC_NONE)
+        self.poolSuffix = compression.suffixFor(self.poolCodec)
 
         checkDirOrCreate(self.spikeOutput)
         checkDirOrCreate(self.spikeWork)
@@ -58,32 +141,21 @@ class spikeObject:
     def combineReadGroups(self):
 
         self.logger.info('Combining read groups')
-        outputPath = self.spikeOutput + '/pool.fasta'
-        outputHandle = open(outputPath, 'w')
+        outputPath = self.spikeOutput + '/pool.fasta' + self.poolSuffix
+        outputHandle = compression.openOutput(outputPath, self.poolCodec)
 
         for readGroup in self.readGroups:
             readGroupName = readGroup[0]
+            readGroupIndex = self.readRegistry.addReadGroup(readGroupName)
             self.logger.debug('Processing: ' + readGroupName)
-            readGroupInputPath = self.barbershopOutput  + '/' + readGroupName + '.fastq'
-            inputHandle = open(readGroupInputPath, 'r')
-            for name, seq, qual in readfq(inputHandle):
-                m = hashlib.sha256()
-                m.update(name.encode('utf-8'))
-                hashedName = m.hexdigest()
-
-                if hashedName in self.seqConnector:
-                    self.logger.warning('Sequence already exists:'  + hashedName + '/' + name)
-
-                outputHandle.write('@' + hashedName + '\n')
-                outputHandle.write(seq + '\n')
-                outputHandle.write('+' + '\n')
-                outputHandle.write(qual + '\n')
-
-                self.seqConnector[hashedName]['originalName'] = name
-                self.seqConnector[hashedName]['readGroupOrigin'] = readGroupName
-                self.seqConnector[hashedName]['originalSeq'] = seq
-
-        self.logger.debug('Written : ' + str(len(self.seqConnector)) + ' reads')
+            readGroupInputPath = compression.resolvePath(self.barbershopOutput  + '/' + readGroupName + '.fastq')
+            for name, seq, qual in fastx.fastqIter(readGroupInputPath, shortName=True):
+                readId = self.readRegistry.addRead(name, readGroupIndex, seq)
+                outputHandle.write('@' + readids.encodeId(readId) + '\n' + seq + '\n+\n' + qual + '\n')
+
+        self.readRegistry.closeReads()
+
+        self.logger.debug('Written : ' + str(self.readRegistry.readCount()) + ' reads')
         outputHandle.close()
         return
 
@@ -94,13 +166,13 @@ class spikeObject:
         self.seqCounter = 0
 
         if specificPool is None:
-            poolPath = self.spikeOutput + '/pool.fasta'
+            poolPath = self.spikeOutput + '/pool.fasta' + self.poolSuffix
         else:
             poolPath = self.spikeOutput + '/' + str(specificPool)
 
             self.logger.debug('Loading pool in memory: ' + str(poolPath))
 
-        for name, seq, qual in fqIter(poolPath):
+        for name, seq, qual in fastx.fastqIter(poolPath):
             if name in self.poolInMemory:
                 raise Exception('I was about to overwrite a sequence! namely this one:' + str(name))
                 sys.exit()
@@ -109,46 +181,25 @@ class spikeObject:
             self.poolInMemory[name]['seq'] = seq
             self.poolInMemory[name]['len'] = len(seq)
             self.poolInMemory[name]['fastq'] = qual
-            self.poolInMemory[name]['qual'] =  [ord(x) - 33 for x in qual.rstrip('\n')]
+            self.poolInMemory[name]['qual'] =  [ord(x) - 33 for x in qual]
             self.seqCounter += 1
 
         return True
 
 
-    def updateContigRegister(self, contigName, contents):
-
-        if contigName in self.contigRegister:
-            self.logger.warning('Contig name already present')
-        else:
-            self.contigRegister[contigName] = contents
-        return
+    """ Number of worker processes that parse phrap results """
+    def ingestProcesses(self, poolN):
+        processes = self.args.getint('spike', 'ingestProcesses', fallback=0)
+        if processes <= 0:
+            processes = availableCores()
+        return max(1, min(processes, poolN))
 
     def recreatePool(self, attrition = None):
 
-        originalSequences = defaultdict(dict)
-
-        if self.currentPass == 0:
-            previousPoolN = '0'
-            previousPool = self.spikeOutput + '/pool.fasta'
-        else:
-            previousPoolN = self.currentPass - 1
-            previousPool = self.spikeOutput + '/pool_' + str(previousPoolN)  +'.fastq'
-
         self.logger.debug('Recreating pool, attrition: ' + str(attrition))
-        self.logger.debug('Previous pool: ' + str(previousPool))
-
-        previousPoolCount = 0
 
-        for name, seq, qual in fqIter(previousPool):
-            originalSequences[name]['name'] = name.rstrip('\n')
-            originalSequences[name]['seq'] = seq.rstrip('\n')
-            originalSequences[name]['fastq'] = qual.rstrip('\n')
-            originalSequences[name]['qual'] =  [ord(x) - 33 for x in qual.rstrip('\n')]
-            previousPoolCount += 1
-
-        poolPath = self.spikeOutput + '/pool_' + str(self.currentPass) + '.fastq'
-        poolHandle = open(poolPath, 'w', 8388608)
-        writtenInPoolHandle = []
+        poolPath = self.spikeOutput + '/pool_' + str(self.currentPass) + '.fastq' + self.poolSuffix
+        poolHandle = compression.openOutput(poolPath, self.poolCodec)
 
         if attrition is None:
             poolN = self.args.getint('spike', 'numberOfPools')
@@ -158,90 +209,62 @@ class spikeObject:
         contigCounter = 0
         singleCounter = 0
 
-        for i in range(0, poolN):
-            contigLocation = self.spikeWork + '/pool_' + str(i) + '.fasta.contigs'
-            contigQualLocation = self.spikeWork + '/pool_' + str(i) + '.fasta.contigs.qual'
-            singletsLocation  = self.spikeWork + '/pool_' + str(i) + '.fasta.singlets'
-            aceLocation = self.spikeWork + '/pool_' + str(i) + '.fasta.ace'
-            contigCompositions = parseAce(aceLocation)
-
-            #store quality values
-            contigQualities = defaultdict(dict)
-
-            for name, qual in qualIter(contigQualLocation):
-                m = hashlib.sha256()
-                m.update(name.encode('utf-8'))
-                hashedName = m.hexdigest()
-                contigQualities[hashedName] =  [chr(int(x) + 33)  for x in qual]
-
-            for name, seq in fastaIter(contigLocation):
-                m = hashlib.sha256()
-                m.update(name.encode('utf-8'))
-                hashedName = m.hexdigest()
-
-                forwardName = ''.join([name, str(contigCounter), str(self.currentPass)])
-                m.update(forwardName.encode('utf-8'))
-                forwardHash = m.hexdigest()
-
-                contigNameSplit = name.split('.')
-                contigNumberName = contigNameSplit[-1]
-
-                thisContigComposition = contigCompositions[contigNumberName]
-                self.updateContigRegister(forwardHash,thisContigComposition)
-
-                thisQuals =  "".join(str(x) for x in contigQualities[hashedName])
-                poolToWrite =  "".join(['@', forwardHash, '\n', seq, '\n', '+',  '\n', thisQuals, '\n' ])
-                poolHandle.write(poolToWrite)
-                contigCounter += 1
-
-            for name, seq in fastaIter(singletsLocation):
+        poolPaths = [self.spikeWork + '/pool_' + str(i) + '.fasta' for i in range(0, poolN)]
+        processes = self.ingestProcesses(poolN)
+        self.logger.debug('Ingesting ' + str(poolN) + ' pools with ' + str(processes) + ' processes')
 
-                newhasher = 'S' + str(name) + str(i) + str(self.currentPass)
-                m = hashlib.sha256()
-                m.update(newhasher.encode('utf-8'))
-                hashedName = m.hexdigest()
-                self.updateContigRegister(hashedName, [name])
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as executor:
+            #results come back in pool order, so contig ids and the pool file match a serial run
+            for members, memberCounts, seqs, quals, singletText, singlets in executor.map(ingestPool, poolPaths):
+                if len(memberCounts):
+                    firstId = self.readRegistry.addContigs(members, memberCounts)
+                    for contig, (seq, qual) in enumerate(zip(seqs.split(b'\n'), quals.split(b'\n'))):
+                        poolHandle.write(''.join(['@', readids.encodeId(firstId + contig), '\n', seq.decode('latin-1'), '\n+\n', qual.decode('latin-1'), '\n']))
+                    contigCounter += len(memberCounts)
 
-                try:
-                    poolToWrite = ''.join(['@', hashedName, '\n', seq, '\n', '+', '\n', originalSequences[name]['fastq'] , '\n'])
-                    poolHandle.write(poolToWrite)
-                except KeyError:
-                    print('Could not find something for sequence: "' + name + '"')
-                    sys.exit()
-
-                singleCounter += 1
+                poolHandle.write(singletText.decode('latin-1'))
+                singleCounter += singlets
 
 
         self.logger.debug('Number of joins: ' + str(contigCounter))
         self.logger.debug('Number of singlets: ' + str(singleCounter))
 
         poolHandle.close()
-        self.loadPoolInMemory('pool_' + str(self.currentPass) + '.fastq')
-        return
+        self.loadPoolInMemory('pool_' + str(self.currentPass) + '.fastq' + self.poolSuffix)
+        return contigCounter, singleCounter
 
     def debugFasta(self, name, seq):
         print('>' + str(name) + str('\n') + str(seq) + str('\n'))
 
-    def doCodonCloneAlignment(self):
-        self.combineReadGroups()
-        self.loadPoolInMemory()
-        self.codonCloneAssemble()
+    """ Runs the assembly, with resume it continues after the last pass of an earlier run that has a checkpoint """
+    def doCodonCloneAlignment(self, resume = False):
+        checkpoint = self.loadCheckpoint() if resume else None
+
+        if checkpoint is None:
+            if resume:
+                self.logger.warning('No spike checkpoint found, starting the assembly from the first pass')
+            self.combineReadGroups()
+            self.loadPoolInMemory()
+            self.codonCloneAssemble()
+        else:
+            self.codonCloneAssemble(checkpoint['step'], checkpoint['pass'] + 1)
+
         assemblyFile = self.tidyUp()
         figureOutContigs = self.unravelContigs(assemblyFile)
         return assemblyFile
 
     def tidyUp(self):
 
-        pool =  self.spikeOutput + '/pool_' + str(self.currentPass)  +'.fastq'
+        pool =  self.spikeOutput + '/pool_' + str(self.currentPass)  +'.fastq' + self.poolSuffix
         self.logger.debug('Generating end result, from: ' + str(pool))
         result =  self.spikeOutput + '/spike_result.fasta'
         resultSorted =  self.spikeOutput + '/spike_result_sorted.fasta'
         nullHandle = open('/dev/null', 'w')
         lengths = []
 
-        outputHandle = open(result, 'w')
+        outputHandle = open(result, 'w', encoding='latin-1')
 
-        for name, seq, qual in fqIter(pool):
+        for name, seq, qual in fastx.fastqIter(pool):
             outputHandle.write('>' + name + '\n')
             outputHandle.write(seq.strip() + '\n')
             lengths.append(len(seq))
@@ -258,95 +281,131 @@ class spikeObject:
 
     def unravelContigs(self, assemblyFile):
 
-        contigFile = open(self.spikeOutput + '/contigregister.txt', 'w')
-        for name, seq in fastaIter(assemblyFile):
+        contigFile = open(self.spikeOutput + '/contigregister.txt', 'w', encoding='latin-1')
+        for name, seq in fastx.fastaIter(assemblyFile):
 
-            toFigureOut = self.contigRegister[name]
             contigFastaFile = self.spikeContigs + '/' + name + '.fasta'
-            contigFasta = open(contigFastaFile, 'w')
-
-            while len(toFigureOut) > 0:
-                for sequence in toFigureOut:
-                    if sequence in self.seqConnector:
-                        #update register
-                        lineToWrite = name + str('\t') + str(self.seqConnector[sequence]['originalName']) + str('\t') + str(self.seqConnector[sequence]['readGroupOrigin']) + str('\n')
-                        contigFile.write(lineToWrite)
-                        #update fasta
-                        contigFasta.write('>' + str(self.seqConnector[sequence]['originalName']) + '\n')
-                        contigFasta.write(str(self.seqConnector[sequence]['originalSeq']) + '\n')
-                        toFigureOut.remove(sequence)
-                    else:
-                        toFigureOut = toFigureOut + self.contigRegister[sequence]
-                        toFigureOut.remove(sequence)
+            contigFasta = open(contigFastaFile, 'w', encoding='latin-1')
 
-            contigFasta.close()
+            for readId in self.readRegistry.reads(readids.decodeId(name)):
+                originalName = self.readRegistry.name(readId)
+                #update register
+                contigFile.write(name + '\t' + originalName + '\t' + self.readRegistry.readGroup(readId) + '\n')
+                #update fasta
+                contigFasta.write('>' + originalName + '\n' + self.readRegistry.sequence(readId) + '\n')
 
-        return
+            contigFasta.close()
 
+        contigFile.close()
 
-    def codonCloneAssemble(self):
+        return
 
-        self.currentPass = 0
-        attrition = 32
-        self.logger.info('** Strict attrition:' + str(attrition))
-        self.createPools(attrition)
-        self.alignPools(attrition, True)
-        self.recreatePool(attrition)
-        self.flushWork()
-
-        # #squeeze strict
-        self.currentPass += 1
-        attrition = 16
-        self.logger.info('** Strict attrition:' + str(attrition))
-        self.createPools(attrition)
-        self.alignPools(attrition, True)
-        self.recreatePool(attrition)
-        self.flushWork()
-
-        self.currentPass += 1
-        attrition = 8
-        self.logger.info('** Strict attrition:' + str(attrition))
-        self.createPools(attrition)
-        self.alignPools(attrition, True)
-        self.recreatePool(attrition)
-        self.flushWork()
-
-        self.currentPass += 1
-        attrition = 4
-        self.logger.info('** Strict attrition:' + str(attrition))
-        self.createPools(attrition)
-        self.alignPools(attrition, True)
-        self.recreatePool(attrition)
-        self.flushWork()
-
-        self.currentPass += 1
-        attrition = 1
-        self.logger.info('** Strict attrition:' + str(attrition))
-        self.createPools(attrition)
-        self.alignPools(attrition, True)
-        self.recreatePool(attrition)
-        self.flushWork()
-
-        self.currentPass += 1
-        attrition = 4
-        self.logger.info('** Loose attrition:' + str(attrition))
-        self.createPools(attrition)
-        self.alignPools(attrition, None)
-        self.recreatePool(attrition)
-        self.flushWork()
-
-
-        self.currentPass += 1
-        attrition = 1
-        self.logger.info('** Loose attrition:' + str(attrition))
-        self.createPools(attrition)
-        self.alignPools(attrition, None)
-        self.recreatePool(attrition)
-        self.flushWork()
 
+    """ Attrition schedule as a list of (pools, profile) passes, from [spike] attritionSchedule
+        (pools:profile, comma separated) or halving numberOfPools strict followed by two loose passes """
+    def attritionSchedule(self):
+        declared = self.args.get('spike', 'attritionSchedule', fallback='').strip()
+        if not declared:
+            pools = self.args.getint('spike', 'numberOfPools')
+            schedule = []
+            while pools > 1:
+                schedule.append((pools, PROFILE_STRICT))
+                pools = pools // 2
+            schedule.append((1, PROFILE_STRICT))
+            return schedule + [(min(4, self.args.getint('spike', 'numberOfPools')), PROFILE_LOOSE), (1, PROFILE_LOOSE)]
+
+        schedule = []
+        for step in declared.split(','):
+            pools, profile = step.strip().split(':')
+            if profile not in PROFILES or int(pools) < 1:
+                raise ValueError('attritionSchedule steps should be <pools>:<' + '|'.join(PROFILES) + '>, not ' + step.strip())
+            schedule.append((int(pools), profile))
+        return schedule
+
+    """ Runs the attrition schedule from step on, the first pass run gets number firstPass """
+    def codonCloneAssemble(self, step = 0, firstPass = 0):
+
+        schedule = self.attritionSchedule()
+        minimumJoinRate = self.args.getfloat('spike', 'minimumJoinRate', fallback=0.0)
+        self.logger.debug('Attrition schedule: ' + ', '.join(str(pools) + ':' + profile for pools, profile in schedule))
+
+        passIndex = firstPass
+        while step < len(schedule):
+            self.currentPass = passIndex
+            attrition, profile = schedule[step]
+            inputSequences = self.seqCounter
+
+            self.logger.info('** ' + profile.capitalize() + ' attrition:' + str(attrition))
+            self.createPools(attrition)
+            self.alignPools(attrition, True if profile == PROFILE_STRICT else None)
+            contigs, singlets = self.recreatePool(attrition)
+            self.flushWork()
+
+            #sequences merged away by this pass
+            joinRate = (inputSequences - contigs - singlets) / inputSequences if inputSequences else 0.0
+            self.logger.info('Join rate: ' + '{:.4f}'.format(joinRate) + ' (' + str(inputSequences) + ' in, ' + str(contigs + singlets) + ' out)')
+
+            step += 1
+            if joinRate < minimumJoinRate and step < len(schedule) - 1:
+                self.logger.info('Join rate below ' + str(minimumJoinRate) + ', skipping to the last pass of the schedule')
+                step = len(schedule) - 1
+
+            self.writeCheckpoint(step, schedule)
+            passIndex += 1
 
         return
 
+    def checkpointPath(self):
+        return spikeCheckpointPath(self.outputPath, self.args)
+
+    """ Persists a finished pass: the lineage of all contigs so far next to the pass pool, then the checkpoint
+        itself is replaced atomically, so an interrupted write leaves the previous checkpoint in place """
+    def writeCheckpoint(self, step, schedule):
+        lineageName = 'lineage_' + str(self.currentPass) + '.npz'
+        self.readRegistry.saveContigs(self.spikeOutput + '/' + lineageName)
+
+        checkpoint = {
+            'pass': self.currentPass,
+            'step': step,
+            'schedule': [[pools, profile] for pools, profile in schedule],
+            'pool': 'pool_' + str(self.currentPass) + '.fastq' + self.poolSuffix,
+            'lineage': lineageName,
+        }
+
+        partialPath = self.checkpointPath() + '.partial'
+        with open(partialPath, 'w') as checkpointHandle:
+            json.dump(checkpoint, checkpointHandle)
+            checkpointHandle.flush()
+            os.fsync(checkpointHandle.fileno())
+        os.replace(partialPath, self.checkpointPath())
+
+        #lineage of earlier passes is contained in this one
+        for name in os.listdir(self.spikeOutput):
+            if name.startswith('lineage_') and name.endswith('.npz') and name != lineageName:
+                os.unlink(self.spikeOutput + '/' + name)
+
+        self.logger.debug('Checkpoint written after pass ' + str(self.currentPass))
+
+    """ Restores the reads, contig lineage and pool of the last checkpointed pass, None without a checkpoint """
+    def loadCheckpoint(self):
+        if not os.path.isfile(self.checkpointPath()):
+            return None
+
+        with open(self.checkpointPath()) as checkpointHandle:
+            checkpoint = json.load(checkpointHandle)
+
+        schedule = [[pools, profile] for pools, profile in self.attritionSchedule()]
+        if schedule != checkpoint['schedule']:
+            self.logger.warning('Attrition schedule changed since the checkpoint, continuing at step ' + str(checkpoint['step']) + ' of the new schedule')
+
+        self.readRegistry.openReads()
+        self.readRegistry.loadContigs(self.spikeOutput + '/' + checkpoint['lineage'])
+        self.loadPoolInMemory(checkpoint['pool'])
+        self.currentPass = checkpoint['pass']
+
+        self.logger.info('Resuming the assembly after pass ' + str(checkpoint['pass']) + ', ' + str(self.seqCounter) + ' sequences in the pool')
+        return checkpoint
+
     def flushWork(self):
 
         for workFile in os.listdir(self.spikeWork):
@@ -369,11 +428,9 @@ class spikeObject:
         self.logger.debug('Attrition:' + str(attrition))
         self.logger.debug('Broad:' + str(broad))
 
-        nullHandle = open('/dev/null', 'w')
-
         if broad == True:
 
-            processes = [Popen([self.args.get('bin', 'phrap'),
+            commands = [[self.args.get('bin', 'phrap'),
                  self.spikeWork + '/pool_' + str(i) + '.fasta',
                 '-penalty', '-3',
                 '-bandwidth', '4',
@@ -396,13 +453,13 @@ class spikeObject:
                 #'-trim_score', '10'
                 '-trim_qual', '2',
                 '-trim_score', '2'
-            ], stdout=nullHandle, stderr=nullHandle, bufsize=1, close_fds=True, universal_newlines=True)
+            ]
             for i in range(0, poolN)]
 
 
 
         if broad == None:
-            processes = [Popen([self.args.get('bin', 'phrap'),
+            commands = [[self.args.get('bin', 'phrap'),
                  self.spikeWork + '/pool_' + str(i) + '.fasta',
                 '-penalty', '-3',
                 '-bandwidth', '4',
@@ -425,24 +482,31 @@ class spikeObject:
                 #'-trim_score', '10'
                 '-trim_qual', '2',
                 '-trim_score', '2'
-            ], stdout=nullHandle, stderr=nullHandle, bufsize=1, close_fds=True, universal_newlines=True)
+            ]
             for i in range(0, poolN)]
 
-        tLeft = poolN
-        while processes:
+        #phrap runs single threaded
+        jobs = scheduler.runJobs([scheduler.job('phrap pool_' + str(i), command) for i, command in enumerate(commands)], logger=self.logger)
+        self.reportPoolCosts(jobs)
+        return
 
-            for p in processes[:]:
-                if p.poll() is not None: # process ended
-                    tLeft =  tLeft - 1
-                    self.logger.debug('PHRAP threads left: ' + str(tLeft))
-                    #print('Threads left' + str(tLeft))
-                    processes.remove(p)
+    def poolCostModel(self):
+        return (self.args.getfloat('spike', 'poolCostPerRead', fallback=1e-4),
+            self.args.getfloat('spike', 'poolCostPerBase', fallback=1e-6),
+            self.args.getfloat('spike', 'poolCostPerBaseSquared', fallback=1e-13))
 
-            time.sleep(1)
+    """ Logs predicted against actual phrap runtime per pool and appends them to poolcosts.tsv for tuning the model """
+    def reportPoolCosts(self, jobs):
+        with open(self.spikeOutput + '/poolcosts.tsv', 'a') as costHandle:
+            for i, (current, prediction) in enumerate(zip(jobs, self.poolPredictions)):
+                reads, bases, predicted = prediction
+                self.logger.debug('Pool ' + str(i) + ': ' + str(reads) + ' reads, ' + str(bases) + ' bases, predicted '
+                    + '{:.1f}'.format(predicted) + 's, actual ' + '{:.1f}'.format(current.wallTime) + 's')
+                costHandle.write('\t'.join(str(x) for x in (self.currentPass, i, reads, bases, predicted, current.wallTime, current.cpuTime)) + '\n')
 
-        nullHandle.close()
-        time.sleep(1)
-        return
+        predictedMax = max(prediction[2] for prediction in self.poolPredictions)
+        actualMax = max(current.wallTime for current in jobs)
+        self.logger.info('Slowest pool: predicted ' + '{:.1f}'.format(predictedMax) + 's, actual ' + '{:.1f}'.format(actualMax) + 's')
 
     def createPools(self, attrition = None):
 
@@ -456,18 +520,32 @@ class spikeObject:
         for i in range(0,poolN):
             handleLocation = self.spikeWork + '/pool_' + str(i) + '.fasta'
             qualLocation = self.spikeWork + '/pool_' + str(i) + '.fasta.qual'
-            self.poolHandles[i]['fasta'] = open(handleLocation, 'w',8388608)
-            self.poolHandles[i]['qual'] = open(qualLocation, 'w',8388608)
+            self.poolHandles[i]['fasta'] = open(handleLocation, 'w', 8388608, encoding='latin-1')
+            self.poolHandles[i]['qual'] = open(qualLocation, 'w', 8388608, encoding='latin-1')
 
-        currentPool = 0
         sortedList = sorted(self.poolInMemory, key=lambda x: (len(self.poolInMemory[x]['seq'])), reverse=True)
         numberOfSequences = len(sortedList)
-        nSeqPerCore = math.floor(numberOfSequences / poolN)
 
         self.logger.debug('Length of list: ' + str(numberOfSequences) )
 
-        #for sequenceName, sequenceInfo in sortedList.items():
-        seqsInThisCore = 0
+        model = self.poolCostModel()
+        lengths = [self.poolInMemory[x]['len'] for x in sortedList]
+
+        if self.args.getboolean('spike', 'enableBinning', fallback=False) and poolN > 1:
+            #reads likely to overlap go to the same pool, bins are the units that get balanced
+            bins = readbins.binReads([self.poolInMemory[x]['seq'] for x in sortedList], sum(lengths) / poolN,
+                self.args.getint('spike', 'binningK', fallback=readbins.DEFAULT_K),
+                self.args.getint('spike', 'binningHashes', fallback=readbins.DEFAULT_HASHES),
+                self.args.getint('spike', 'binningBandRows', fallback=readbins.DEFAULT_BAND_ROWS))
+            binReads = numpy.bincount(bins)
+            binBases = numpy.bincount(bins, weights=lengths).astype(numpy.int64)
+            self.logger.debug('Binned ' + str(numberOfSequences) + ' reads in ' + str(len(binReads)) + ' bins, largest bin: ' + str(binReads.max()) + ' reads')
+
+            binPools, self.poolPredictions = balancePools(list(zip(binReads.tolist(), binBases.tolist())), poolN, model)
+            assignment = [binPools[x] for x in bins.tolist()]
+        else:
+            assignment, self.poolPredictions = balancePools([(1, length) for length in lengths], poolN, model)
+
         seqsWritten = 0
 
         #some diagnosics
@@ -475,7 +553,7 @@ class spikeObject:
         seqsOver1kbLengths = []
         seqsOver1KbTotal = 0
 
-        for sequenceName in sortedList:
+        for sequenceName, currentPool in zip(sortedList, assignment):
 
             sequenceInfo = self.poolInMemory[sequenceName]
             seqLen = len(sequenceInfo['seq'])
@@ -490,15 +568,6 @@ class spikeObject:
 
             qualAsStr = ' '.join(map(str, sequenceInfo['qual']))
             self.poolHandles[currentPool]['qual'].write( ''.join(['>', sequenceName, '\n', qualAsStr , '\n']))
-            seqsInThisCore += 1
-
-            if seqsInThisCore == nSeqPerCore:
-                currentPool = currentPool + 1
-                if currentPool >= poolN:
-                    currentPool -= 1
-                else:
-                    seqsInThisCore = 0
-
 
         self.logger.debug('Sequences written: ' + str(seqsWritten))
         self.logger.debug('Sequences over 1KB : ' + str(seqsOver1kb))
@@ -0,0 +1,24 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import diginorm
+
+def kmersPerRead(seqs, k):
+    return [sum(1 for i in range(len(seq) - k + 1) if 'N' not in seq[i:i + k]) for seq in seqs]
+
+def test_batch_slots_follow_forward_windows():
+    seqs = ['ACGTTGCAAGGCTTAGCAT', 'GGATNCCATGACGTACGATCGAT', 'ACG', 'TTGACNNAGCTAGGCATGCATCGGACT']
+    sketch = diginorm.depthSketch(k=8, tables=2, tableBits=10)
+    slots, bounds = sketch.batchSlots(seqs)
+    assert list(np.diff(bounds)) == kmersPerRead(seqs, 8)
+
+def test_batch_slots_do_not_depend_on_batch_neighbours():
+    seqs = ['ACGTTGCAAGGCTTAGCAT', 'GGATNCCATGACGTACGATCGAT', 'ACG', 'TTGACNNAGCTAGGCATGCATCGGACT']
+    sketch = diginorm.depthSketch(k=8, tables=2, tableBits=10)
+    slots, bounds = sketch.batchSlots(seqs)
+    for i, seq in enumerate(seqs):
+        single, singleBounds = sketch.batchSlots([seq])
+        assert np.array_equal(slots[:, bounds[i]:bounds[i + 1]], single)
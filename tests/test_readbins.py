@@ -0,0 +1,23 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import readbins
+
+READ = 'ACGTTGCAAGGCTTAGCATGGATCCATGACGTACGATCGATTTGACAGCTAGG'
+OTHER = 'TTTTGGGGCCCCAAAATGCATGCATCGGACTNNGATCGGATCAGGT'
+
+def test_identical_reads_get_identical_sketches():
+    seqs = ['GGCAT', READ, OTHER, READ, 'ACNGTACGT', READ, OTHER[::-1]]
+    sketches = readbins.sketchReads(seqs, k=12, hashes=8)
+    single = readbins.sketchReads([READ], k=12, hashes=8)[0]
+    for i in (1, 3, 5):
+        assert np.array_equal(sketches[i], single)
+
+def test_identical_reads_are_binned_together():
+    seqs = [READ, READ, READ, OTHER]
+    a, b = readbins.bandLinks(readbins.sketchReads(seqs, k=12, hashes=8), 2)
+    components = readbins.connectedComponents(len(seqs), a, b)
+    assert components[0] == components[1] == components[2]
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import shutil
+from collections import Counter
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import fastx
+import compression
+import qualstats
+import rejects
+from cactusUtils import compressionRatio, availableCores
+
+""" trimmer.py: Read level quality trimming used by the barbershop
+
+    The [barbershop] settings are read once into a plain dict so worker processes
+    do not need the config parser. Uncompressed input is split into byte ranges
+    aligned to FASTQ records and every range is trimmed by its own process into
+    part files, which are concatenated in order afterwards. Compressed input is
+    parsed in the main process and trimmed in batches on the pool. Either way the
+    output is identical to a serial run. Rejected reads go to a rejects.rejectSink,
+    ordinals are counted from the start of the input. Quality histograms of all
+    input reads are merged over the workers and saved as one .npz summary.
+"""
+
+BATCH_SIZE = 20000
+COUNTERS = ['readsDropped', 'readsCompressionRatioDropped', 'readsSalvaged', 'readsWritten']
+
+""" Snapshot of the trimmer settings in a picklable dict """
+def trimmerSettings(args):
+    return {
+        'checkCompressionRatio': args.getboolean('barbershop', 'checkCompressionRatio'),
+        'compressionRatioCutOff': args.getfloat('barbershop', 'compressionRatioCutOff'),
+        'trimOnlyLength': args.getboolean('barbershop', 'trimOnlyLength'),
+        'minLength': args.getint('barbershop', 'minLength'),
+        'minAverageQuality': args.getint('barbershop', 'minAverageQuality'),
+        'maxNumberOfDips': args.getint('barbershop', 'maxNumberOfDips'),
+        'dipCheckTreshold': args.getint('barbershop', 'dipCheckTreshold'),
+        'salvageEnabled': args.getboolean('barbershop', 'salvageEnabled'),
+        'salvageLength': args.getint('barbershop', 'salvageLength'),
+    }
+
+""" Number of trimmer processes, 0 means all cores available to this process """
+def trimmerProcesses(args):
+    processes = args.getint('barbershop', 'trimmerProcesses', fallback=1)
+    if processes <= 0:
+        processes = availableCores()
+    return processes
+
+def newCounters():
+    return Counter({counter: 0 for counter in COUNTERS})
+
+""" Trims records and writes them to the output handle and reject sink, returns the counters """
+def trimRecords(records, settings, outputHandle, rejectSink, histograms):
+    counters = newCounters()
+    fastx.writeFastq(outputHandle, trimStream(records, settings, rejectSink, histograms, counters))
+    return counters
+
+""" Trims a record stream and yields the kept records in input order, counters and histograms are updated
+    as the stream is consumed. With more than one process batches are trimmed on a process pool """
+def trimStream(records, settings, rejectSink, histograms, counters, processes = 1):
+    if processes > 1:
+        yield from _trimBatches(records, settings, rejectSink, histograms, counters, processes)
+        return
+
+    batch = []
+    firstOrdinal = 0
+
+    for record in records:
+        batch.append(record)
+        if len(batch) == BATCH_SIZE:
+            yield from trimRecordBatch(batch, firstOrdinal, settings, rejectSink, histograms, counters)
+            firstOrdinal += len(batch)
+            batch = []
+
+    if batch:
+        yield from trimRecordBatch(batch, firstOrdinal, settings, rejectSink, histograms, counters)
+
+""" Keep, salvage or reject decisions for a whole batch, quality statistics are computed in one vectorized pass.
+    Returns the kept records """
+def trimRecordBatch(batch, firstOrdinal, settings, rejectSink, histograms, counters):
+    kept = []
+
+    stats = qualstats.qualityBatch([qual for name, seq, qual in batch])
+    averageQualities = stats.averageQuality()
+    dipSums = stats.dipCounts(settings['dipCheckTreshold'])
+    histograms.update(stats, averageQualities, dipSums)
+
+    if settings['trimOnlyLength'] is False:
+        lengthOk = stats.lengthMask(settings['minLength'])
+
+        keep = (averageQualities >= settings['minAverageQuality']) & (dipSums < settings['maxNumberOfDips']) & lengthOk
+        salvage = ~keep & settings['salvageEnabled'] & (stats.lengths > settings['salvageLength'])
+
+        averageQualities = averageQualities.tolist()
+        dipSums = dipSums.tolist()
+        keep = keep.tolist()
+        salvage = salvage.tolist()
+
+    for i, (name, seq, qual) in enumerate(batch):
+
+        if settings['checkCompressionRatio'] is True:
+            thisCompressionRatio = compressionRatio(seq)
+            if ( thisCompressionRatio <= settings['compressionRatioCutOff']):
+                rejectSink.reject(firstOrdinal + i, rejects.TRIMMER_COMPRESSION_RATIO, name, seq, qual, thisCompressionRatio)
+                counters['readsDropped'] += 1
+                counters['readsCompressionRatioDropped'] += 1
+                continue
+
+        #length only
+        if settings['trimOnlyLength'] is True:
+            if ( len(seq) >=  settings['minLength']):
+                kept.append(batch[i])
+                counters['readsWritten'] += 1
+            else:
+                rejectSink.reject(firstOrdinal + i, rejects.TRIMMER_TOO_SHORT, name, seq, qual)
+                counters['readsDropped'] += 1
+        else:
+            if keep[i]:
+                kept.append(batch[i])
+                counters['readsWritten'] += 1
+            elif salvage[i]:
+                kept.append(batch[i])
+                counters['readsSalvaged'] += 1
+                counters['readsWritten'] += 1
+            else:
+                rejectSink.reject(firstOrdinal + i, rejects.TRIMMER_QUALITY_OR_LENGTH, name, seq, qual, averageQualities[i], dipSums[i])
+                counters['readsDropped'] += 1
+
+    return kept
+
+""" Trims one byte range of the input into its own set of output files, returns the counters and quality histograms """
+def trimChunk(inputPath, byteRange, settings, outputPath, rejectPath, codec, rejectMode = rejects.SINK_FASTQ):
+    histograms = qualstats.qualityHistograms()
+    with fastx.fastxReader(inputPath, fastx.MODE_FASTQ, shortName=True, byteRange=byteRange) as reader, \
+        compression.openOutput(outputPath, codec) as outputHandle, \
+        rejects.rejectSink(rejectPath, rejectMode, append=False) as rejectSink:
+        return trimRecords(reader, settings, outputHandle, rejectSink, histograms), histograms
+
+""" Trims a batch of records in memory, returns the kept records, the reject sink payload, the quality histograms and the counters """
+def trimBatch(records, settings, rejectMode = rejects.SINK_FASTQ):
+    rejectSink = rejects.rejectSink(None, rejectMode)
+    histograms = qualstats.qualityHistograms()
+    counters = newCounters()
+    kept = trimRecordBatch(records, 0, settings, rejectSink, histograms, counters)
+    return kept, rejectSink.payload(), histograms, counters
+
+""" Runs the trimmer over inputPath, rejectPath is the reject sink path without suffix and the quality
+    histograms are saved to summaryPath, returns the summed counters """
+def runTrimmer(inputPath, outputPath, rejectPath, summaryPath, settings, codec = compression.CODEC_NONE, processes = 1, rejectMode = rejects.SINK_FASTQ):
+    if processes <= 1:
+        counters, histograms = trimChunk(inputPath, None, settings, outputPath, rejectPath, codec, rejectMode)
+    elif compression.detectCompression(inputPath) != compression.CODEC_NONE:
+        counters, histograms = _runBatches(inputPath, outputPath, rejectPath, settings, codec, processes, rejectMode)
+    else:
+        counters, histograms = _runChunks(inputPath, outputPath, rejectPath, settings, codec, processes, rejectMode)
+
+    histograms.save(summaryPath)
+    return counters
+
+def _runChunks(inputPath, outputPath, rejectPath, settings, codec, processes, rejectMode):
+    byteRanges = fastx.fastqByteRanges(inputPath, processes * 4)
+    parts = [(outputPath + '.part' + str(i), rejectPath + '.part' + str(i)) for i in range(len(byteRanges))]
+
+    counters = newCounters()
+    histograms = qualstats.qualityHistograms()
+    ordinalOffsets = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(trimChunk, inputPath, byteRange, settings, part[0], part[1], codec, rejectMode)
+            for byteRange, part in zip(byteRanges, parts)]
+        for future in futures:
+            ordinalOffsets.append(counters['readsDropped'] + counters['readsWritten'])
+            chunkCounters, chunkHistograms = future.result()
+            counters.update(chunkCounters)
+            histograms.merge(chunkHistograms)
+
+    #gzip members can be concatenated as-is, so compressed parts merge the same way
+    with open(outputPath, 'wb') as targetHandle:
+        for part in parts:
+            with open(part[0], 'rb') as partHandle:
+                shutil.copyfileobj(partHandle, targetHandle, 1024*1024*10)
+            os.unlink(part[0])
+
+    rejects.mergeParts([part[1] for part in parts], rejectPath, rejectMode, ordinalOffsets, append=False)
+    return counters, histograms
+
+def _runBatches(inputPath, outputPath, rejectPath, settings, codec, processes, rejectMode):
+    counters = newCounters()
+    histograms = qualstats.qualityHistograms()
+
+    with compression.openOutput(outputPath, codec) as outputHandle, \
+        rejects.rejectSink(rejectPath, rejectMode, append=False) as rejectSink:
+        fastx.writeFastq(outputHandle, _trimBatches(fastx.fastqIter(inputPath, shortName=True), settings, rejectSink, histograms, counters, processes))
+
+    return counters, histograms
+
+def _trimBatches(records, settings, rejectSink, histograms, counters, processes):
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = deque()
+
+        def collect():
+            kept, rejected, batchHistograms, batchCounters = pending.popleft().result()
+            rejectSink.extend(rejected, counters['readsDropped'] + counters['readsWritten'])
+            histograms.merge(batchHistograms)
+            counters.update(batchCounters)
+            return kept
+
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == BATCH_SIZE:
+                pending.append(executor.submit(trimBatch, batch, settings, rejectSink.mode))
+                batch = []
+                if len(pending) >= processes * 2:
+                    yield from collect()
+
+        if batch:
+            pending.append(executor.submit(trimBatch, batch, settings, rejectSink.mode))
+
+        while pending:
+            yield from collect()